@@ -0,0 +1,203 @@
+"""
+Authors:
+Gonçalo Leal - 98008
+Ricardo Rodriguez - 98388
+
+Boolean retrieval (searcher --boolean).
+
+Queries use the AND, OR and NOT operators (upper case, so they are not confused
+with the words of the documents) and parentheses, adjacent terms are joined with AND:
+    kinase AND inhibitor NOT cancer
+    (kinase OR phosphatase) inhibitor AND NOT (cancer OR tumor)
+NOT has the highest precedence, followed by AND and then OR.
+
+Every term is a ("term", token) node and the operators are ("and", [nodes]),
+("or", [nodes]) and ("not", node) nodes. Conjunctions are evaluated with the
+PostingCursor of each term, starting from the smallest operand, so the cost of
+intersecting a rare and a common term is close to the size of the rare one.
+Only the documents with a term that is not negated can be ranked, so NOT is the
+complement within them (see rankable_documents) instead of within the whole
+collection, and a query whose terms are all negated matches nothing.
+"""
+
+import re
+
+QUERY_ITEMS = re.compile(r'\(|\)|[^\s()]+')
+OPERATORS = ("AND", "OR", "NOT")
+
+
+class BooleanQuery:
+
+    def __init__(self, tokenizer, query):
+        self.tokenizer = tokenizer
+        self.items = QUERY_ITEMS.findall(query)
+        self.position = 0
+        self.tree = self.parse_or() if self.items else None
+        # sorted doc ids of the documents with a positive term, computed on the first NOT
+        self.rankable = None
+
+    def peek(self):
+        return self.items[self.position] if self.position < len(self.items) else None
+
+    def next(self):
+        item = self.peek()
+        self.position += 1
+        return item
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.peek() == "OR":
+            self.next()
+            operands.append(self.parse_and())
+        return self.join("or", operands)
+
+    def parse_and(self):
+        operands = [self.parse_not()]
+        while self.peek() is not None and self.peek() not in ("OR", ")"):
+            if self.peek() == "AND":
+                self.next()
+            operands.append(self.parse_not())
+        return self.join("and", operands)
+
+    def parse_not(self):
+        if self.peek() == "NOT":
+            self.next()
+            operand = self.parse_not()
+            return ("not", operand) if operand is not None else None
+
+        item = self.next()
+        if item is None:
+            return None
+
+        if item == "(":
+            node = self.parse_or()
+            if self.peek() == ")":
+                self.next()
+            return node
+
+        if item in OPERATORS or item == ")":
+            # misplaced operator, it is ignored
+            return None
+
+        # a word may be split in several tokens (or none if it is a stopword)
+        tokens = self.tokenizer.tokenize(item)
+        return self.join("and", [("term", token) for token in tokens])
+
+    @staticmethod
+    def join(operator, operands):
+        """
+        Joins the operands that are not empty (None)
+        """
+        operands = [operand for operand in operands if operand is not None]
+        if not operands:
+            return None
+        if len(operands) == 1:
+            return operands[0]
+        return (operator, operands)
+
+    def positive_terms(self, node=None):
+        """
+        Tokens that are not negated, used to rank the documents that match the query
+        """
+
+        node = self.tree if node is None else node
+        if node is None or node[0] == "not":
+            return []
+        if node[0] == "term":
+            return [node[1]]
+        return [token for operand in node[1] for token in self.positive_terms(operand)]
+
+    def evaluate(self, index):
+        """
+        Returns the sorted doc ids of the documents that match the query
+        """
+
+        if self.tree is None or not self.positive_terms():
+            # there are no terms to rank the documents with
+            return []
+        return self.evaluate_node(index, self.tree)
+
+    def rankable_documents(self, index):
+        """
+        Sorted doc ids of the documents that have at least one positive term,
+        the others can't be ranked, so the negated operands are excluded from these
+        (the cost is the size of the positive terms' posting lists, not O(documents))
+        """
+
+        if self.rankable is None:
+            self.rankable = self.evaluate_node(
+                index, ("or", [("term", token) for token in set(self.positive_terms())])
+            )
+        return self.rankable
+
+    def evaluate_node(self, index, node):
+        if node[0] == "term":
+            cursor = index.open_cursor(node[1])
+            return cursor.doc_ids() if cursor is not None else []
+
+        if node[0] == "or":
+            doc_ids = set()
+            for operand in node[1]:
+                doc_ids.update(self.evaluate_node(index, operand))
+            return sorted(doc_ids)
+
+        if node[0] == "not":
+            excluded = set(self.evaluate_node(index, node[1]))
+            return [doc_id for doc_id in self.rankable_documents(index) if doc_id not in excluded]
+
+        return self.evaluate_and(index, node[1])
+
+    def evaluate_and(self, index, operands):
+        """
+        Intersection of the operands, the smallest one is fully evaluated and its
+        doc ids are looked up in the others (terms with cursors, so their skip
+        pointers avoid decoding the postings in between)
+        """
+
+        # [size, doc ids or cursor] of the operands
+        included = []
+        excluded = []
+        for operand in operands:
+            negated = operand[0] == "not"
+            if negated:
+                operand = operand[1]
+
+            if operand[0] == "term":
+                cursor = index.open_cursor(operand[1])
+                if cursor is None:
+                    if negated:
+                        continue
+                    return []
+                evaluated = [len(cursor), cursor]
+            else:
+                doc_ids = self.evaluate_node(index, operand)
+                evaluated = [len(doc_ids), set(doc_ids)]
+                if not doc_ids and not negated:
+                    return []
+
+            (excluded if negated else included).append(evaluated)
+
+        if included:
+            included.sort(key=lambda evaluated: evaluated[0])
+            smallest = included.pop(0)[1]
+            candidates = smallest.doc_ids() if not isinstance(smallest, set) else sorted(smallest)
+        else:
+            # only negated operands
+            candidates = self.rankable_documents(index)
+
+        doc_ids = []
+        for doc_id in candidates:
+            if all(self.contains(operand, doc_id) for _, operand in included) and \
+                    not any(self.contains(operand, doc_id) for _, operand in excluded):
+                doc_ids.append(doc_id)
+        return doc_ids
+
+    @staticmethod
+    def contains(operand, doc_id):
+        """
+        Checks if the operand (set of doc ids or cursor) has the doc id
+        the doc ids must be checked in increasing order
+        """
+        if isinstance(operand, set):
+            return doc_id in operand
+        return operand.advance(doc_id) == doc_id
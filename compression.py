@@ -0,0 +1,239 @@
+"""
+Authors:
+Gonçalo Leal - 98008
+Ricardo Rodriguez - 98388
+
+Binary posting format used by the index when --indexer.posting_format binary is set.
+
+Every integer is written as a variable-byte (varint) integer: 7 bits per byte,
+the most significant bit tells if there are more bytes to read.
+
+A final block file (final_block_<n>.bin) is a sequence of records:
+    <term length> <term (utf-8)> <payload length> <payload>
+and the payload of a term is:
+    <n postings> [<doc id gap> <tf> <position gap> * tf] * n postings
+Doc ids are gap-encoded against the previous posting of the term and positions
+are gap-encoded against the previous position in the same document.
+
+Indexes with precomputed BM25 impacts (--indexer.bm25.impacts) also store the
+impact of every posting right after its doc id gap, as a double ("double") or
+as a single byte when the impacts are quantized to 8 bits ("uint8").
+
+Indexes with separate positions (--indexer.positions_storage separate) keep the
+positions of every posting in positions.bin as <tf> <position gap> * tf and the
+payload only has the offset of those positions:
+    <n postings> [<doc id gap> <tf> <positions offset gap>] * n postings
+The offsets are gap-encoded against the previous posting of the term.
+"""
+
+import struct
+
+IMPACT_FORMATS = {"double": struct.Struct("<d"), "uint8": struct.Struct("<B")}
+
+def encode_varint(value, buffer):
+    """
+    Appends value (non negative integer) to the buffer (bytearray) as a varint
+    """
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+def decode_varint(data, offset):
+    """
+    Reads a varint from data starting at offset
+    Returns the value and the offset of the next byte
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def encode_postings(postings, impacts=None, impact_format=None, skip_interval=None, skip_offsets=None,
+                    positions_offsets=None):
+    """
+    Encodes a list of (doc_id, tf, positions) sorted by doc_id into the payload of a term
+    impacts (optional) holds the impact of every posting, written with impact_format
+    If skip_interval is given, the offset (in the payload) of every skip_interval-th
+    posting is appended to skip_offsets (skip pointers)
+    If positions_offsets is given (offset of the positions of every posting in the
+    positions file), it is written instead of the positions
+    """
+    buffer = bytearray()
+    encode_varint(len(postings), buffer)
+
+    impact_struct = IMPACT_FORMATS[impact_format] if impacts is not None else None
+
+    previous_doc = 0
+    previous_positions_offset = 0
+    for i, (doc_id, tf, positions) in enumerate(postings):
+        if skip_interval and i % skip_interval == 0:
+            skip_offsets.append(len(buffer))
+        encode_varint(doc_id - previous_doc, buffer)
+        if impact_struct is not None:
+            buffer += impact_struct.pack(impacts[i])
+        encode_varint(tf, buffer)
+        if positions_offsets is not None:
+            encode_varint(positions_offsets[i] - previous_positions_offset, buffer)
+            previous_positions_offset = positions_offsets[i]
+        else:
+            encode_positions(positions, buffer, with_tf=False)
+        previous_doc = doc_id
+
+    return bytes(buffer)
+
+def encode_positions(positions, buffer, with_tf=True):
+    """
+    Appends the gap encoded positions of a posting to the buffer,
+    preceded by their number (tf) when with_tf is set (positions file)
+    """
+    if with_tf:
+        encode_varint(len(positions), buffer)
+    previous_position = 0
+    for position in positions:
+        encode_varint(position - previous_position, buffer)
+        previous_position = position
+
+def decode_positions(data, offset, tf=None):
+    """
+    Decodes tf gap encoded positions starting at offset, the tf is read
+    from data first when it isn't given (positions file)
+    Returns the positions and the offset of the next byte
+    """
+    if tf is None:
+        tf, offset = decode_varint(data, offset)
+
+    positions = []
+    position = 0
+    for _ in range(tf):
+        gap, offset = decode_varint(data, offset)
+        position += gap
+        positions.append(position)
+    return positions, offset
+
+def decode_postings(data, impact_format=None, separate_positions=False):
+    """
+    Decodes the payload of a term
+    Returns a list of (doc_id, tf, positions)
+    or (doc_id, tf, positions, impact) if the payload has impacts (impact_format)
+    With separate_positions the offset of the positions in the positions file
+    is returned instead of the positions
+    """
+    n_postings, offset = decode_varint(data, 0)
+
+    impact_struct = IMPACT_FORMATS[impact_format] if impact_format is not None else None
+
+    postings = []
+    doc_id = 0
+    positions_offset = 0
+    for _ in range(n_postings):
+        gap, offset = decode_varint(data, offset)
+        doc_id += gap
+        if impact_struct is not None:
+            impact = impact_struct.unpack_from(data, offset)[0]
+            offset += impact_struct.size
+        tf, offset = decode_varint(data, offset)
+
+        if separate_positions:
+            gap, offset = decode_varint(data, offset)
+            positions_offset += gap
+            positions = positions_offset
+        else:
+            positions, offset = decode_positions(data, offset, tf)
+
+        if impact_struct is not None:
+            postings.append((doc_id, tf, positions, impact))
+        else:
+            postings.append((doc_id, tf, positions))
+
+    return postings
+
+def decode_doc_ids(data, offset, count, previous_doc=0, impact_format=None, separate_positions=False):
+    """
+    Decodes only the doc ids of count postings of a payload, starting at offset
+    (a skip pointer), previous_doc is the doc id of the posting before offset
+    The positions (or their offsets) are skipped without being decoded
+    """
+
+    impact_size = IMPACT_FORMATS[impact_format].size if impact_format is not None else 0
+
+    doc_ids = []
+    doc_id = previous_doc
+    for _ in range(count):
+        gap, offset = decode_varint(data, offset)
+        doc_id += gap
+        doc_ids.append(doc_id)
+        offset += impact_size
+
+        tf, offset = decode_varint(data, offset)
+        for _ in range(tf if not separate_positions else 1):
+            # skip the varint of the position (or of the positions offset)
+            while data[offset] >= 0x80:
+                offset += 1
+            offset += 1
+
+    return doc_ids
+
+def decode_doc_weights(data, offset, count, previous_doc=0, impact_format=None, separate_positions=False):
+    """
+    Same as decode_doc_ids, but also decodes the weight of every posting:
+    its impact if the payload has impacts (impact_format), otherwise its tf
+    Returns the doc ids and the weights as two lists
+    """
+
+    impact_struct = IMPACT_FORMATS[impact_format] if impact_format is not None else None
+
+    doc_ids = []
+    weights = []
+    doc_id = previous_doc
+    for _ in range(count):
+        gap, offset = decode_varint(data, offset)
+        doc_id += gap
+        doc_ids.append(doc_id)
+        if impact_struct is not None:
+            weights.append(impact_struct.unpack_from(data, offset)[0])
+            offset += impact_struct.size
+
+        tf, offset = decode_varint(data, offset)
+        if impact_struct is None:
+            weights.append(tf)
+        for _ in range(tf if not separate_positions else 1):
+            # skip the varint of the position (or of the positions offset)
+            while data[offset] >= 0x80:
+                offset += 1
+            offset += 1
+
+    return doc_ids, weights
+
+def encode_record(term, payload):
+    """
+    Encodes a <term length> <term> <payload length> <payload> record
+    """
+    term = term.encode("utf-8")
+    buffer = bytearray()
+    encode_varint(len(term), buffer)
+    buffer += term
+    encode_varint(len(payload), buffer)
+    buffer += payload
+    return bytes(buffer)
+
+def read_varint(file):
+    """
+    Reads a varint from a binary file object
+    Returns None at the end of the file
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = file.read(1)
+        if not byte:
+            return None
+        value |= (byte[0] & 0x7F) << shift
+        if byte[0] < 0x80:
+            return value
+        shift += 7
@@ -12,7 +12,8 @@ based on the operation mode.
 from tokenizers import dynamically_init_tokenizer
 from reader import dynamically_init_reader
 from index import dynamically_init_indexer, BaseIndex
-from searcher import dynamically_init_searcher
+from searcher import dynamically_init_searcher, QueryResultCache
+from server import QueryServer
 
 def add_more_options_to_indexer(indexer_parser, indexer_settings_parser, indexer_doc_parser):
     """Add more options to the main program argparser.
@@ -75,7 +76,28 @@ def engine_logic(args):
                        args.reader,
                        args.tk,
                        args.ranking,
-                       args.interactive)
+                       args.interactive,
+                       args.posting_cache_mb,
+                       args.boolean,
+                       args.workers,
+                       args.result_cache_size,
+                       args.result_cache_ttl,
+                       args.result_cache_path,
+                       args.phrases)
+
+    elif args.mode == "server":
+        server_logic(args.index_folder,
+                     args.host,
+                     args.port,
+                     args.unix_socket,
+                     args.top_k,
+                     args.max_concurrency,
+                     args.tk,
+                     args.ranking,
+                     args.posting_cache_mb,
+                     args.result_cache_size,
+                     args.result_cache_ttl,
+                     args.result_cache_path)
         
     else:
         # this should be ensured by the argparser
@@ -132,7 +154,14 @@ def searcher_logic(
                    reader_args,
                    tk_args,
                    ranking_args,
-                   interactive
+                   interactive,
+                   posting_cache_mb,
+                   boolean,
+                   workers=None,
+                   result_cache_size=None,
+                   result_cache_ttl=None,
+                   result_cache_path=None,
+                   phrases=False
                    ):
 
     print("[CORE]", index_folder, top_k, boost, ranking_args)
@@ -141,10 +170,26 @@ def searcher_logic(
                                     **reader_args.get_kwargs())
 
     ranker = dynamically_init_searcher(interactive=interactive,
+                                    boolean=boolean,
+                                    phrases=phrases,
                                     **ranking_args.get_kwargs())
 
+    index, tokenizer = load_index_and_tokenizer(index_folder, tk_args, posting_cache_mb)
+
+    ranker.result_cache = load_result_cache(index, result_cache_size, result_cache_ttl, result_cache_path)
+
+    ranker.batch_search(index, reader, tokenizer, output_file, top_k=top_k, boost=boost, workers=workers)
+
+    if ranker.result_cache is not None:
+        ranker.result_cache.save(index)
+
+def load_index_and_tokenizer(index_folder, tk_args, posting_cache_mb):
+    """
+    Loads the index from disk and initializes the tokenizer used to build it
+    """
+
     # load the index from disk
-    index = BaseIndex.load_from_disk(index_folder)
+    index = BaseIndex.load_from_disk(index_folder, posting_cache_mb=posting_cache_mb)
 
     stored_tokenizer_kwargs = index.get_tokenizer_kwargs()
     if stored_tokenizer_kwargs:
@@ -158,4 +203,46 @@ def searcher_logic(
 
     tokenizer = dynamically_init_tokenizer(**tk_kwargs)
 
-    ranker.batch_search(index, reader, tokenizer, output_file, top_k=top_k, boost=boost)
\ No newline at end of file
+    return index, tokenizer
+
+def load_result_cache(index, result_cache_size, result_cache_ttl, result_cache_path):
+    """
+    Creates the query result cache (None if it is disabled) with the results saved
+    in result_cache_path by a previous run over the same index
+    """
+
+    if not result_cache_size:
+        return None
+
+    result_cache = QueryResultCache(result_cache_size, ttl=result_cache_ttl, path=result_cache_path)
+    result_cache.load(index)
+    return result_cache
+
+def server_logic(index_folder,
+                 host,
+                 port,
+                 unix_socket,
+                 top_k,
+                 max_concurrency,
+                 tk_args,
+                 ranking_args,
+                 posting_cache_mb,
+                 result_cache_size=None,
+                 result_cache_ttl=None,
+                 result_cache_path=None):
+    """
+    Entrypoint of the server mode, the index is loaded once
+    and the queries are answered by the QueryServer until it is stopped
+    """
+
+    print("[CORE]", index_folder, top_k, ranking_args)
+
+    index, tokenizer = load_index_and_tokenizer(index_folder, tk_args, posting_cache_mb)
+
+    result_cache = load_result_cache(index, result_cache_size, result_cache_ttl, result_cache_path)
+
+    server = QueryServer(
+        index, tokenizer, ranking_args.get_kwargs(), top_k=top_k, max_concurrency=max_concurrency,
+        result_cache=result_cache
+    )
+    server.run(host, port, unix_socket)
\ No newline at end of file
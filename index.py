@@ -5,11 +5,58 @@ Ricardo Rodriguez - 98388
 """
 
 from time import time, strftime, gmtime
-from math import log10, sqrt
+from math import log10
+from itertools import groupby, accumulate
+from operator import itemgetter
+from collections import OrderedDict
+from array import array
 import os
-import psutil
-import linecache
+import re
+import sys
+import heapq
+import multiprocessing
+import queue
+import threading
+import mmap
+import struct
+import numpy as np
+from bisect import bisect_left
 from utils import dynamically_init_class
+from compression import encode_postings, decode_postings, decode_doc_ids, decode_doc_weights, encode_record, \
+    read_varint, encode_positions, decode_positions
+
+# Documents are identified by dense integer ids (the n-th document read by the indexer has id n)
+# doc_pmids.txt maps every doc id to its pmid (one per line) and doc_lengths.bin
+# holds the number of tokens of every document (uint32 array indexed by doc id)
+DOC_LENGTHS_FILENAME = "doc_lengths.bin"
+DOC_PMIDS_FILENAME = "doc_pmids.txt"
+# tfidf document norms (cosine or pivoted unique), array of doubles indexed by doc id
+DOC_NORMS_FILENAME = "doc_norms.bin"
+# bm25 posting lists are split in blocks of BLOCK_MAX_SIZE postings and, for every block,
+# block_max.bin holds the last doc id and the max score of the block (Block-Max WAND)
+BLOCK_MAX_FILENAME = "block_max.bin"
+BLOCK_MAX_SIZE = 64
+# skip pointers of every posting list (boolean retrieval), one every SKIP_INTERVAL postings
+# with the last doc id of the postings it skips, the offset of the posting in the
+# postings of the term and the doc id before it (needed by the gap encoded binary format)
+SKIP_POINTERS_FILENAME = "skip_pointers.bin"
+SKIP_INTERVAL = 64
+# positions of every posting when they are stored apart from the postings
+# (--indexer.positions_storage separate), the postings hold their offset in this file
+POSITIONS_FILENAME = "positions.bin"
+# maximum number of temporary blocks merged at once (open files and read buffers),
+# with more blocks they are first merged in groups into bigger temporary blocks
+MERGE_FAN_IN = 64
+# number of (k1, b) length normalizations kept in memory by a searcher
+BM25_LENGTH_NORMS_CACHE_SIZE = 4
+# doc id and weight of every posting of a temporary (or final text) block line (<doc>:<weight>:[<positions>];...)
+POSTING_FIELDS = re.compile(r'(?:^|;)(\d+):([^:;]*):')
+# estimated memory (bytes) of a term in the in-memory index, used by the memory budget
+# (measured with tracemalloc on PubMed blocks): its entry in the index and its empty
+# TermPostings buffers, the size of its string and of its postings are added to it
+TERM_MEMORY = 300
+# in-memory index size (MB) when --indexer.memory_budget_mb isn't given
+DEFAULT_MEMORY_BUDGET_MB = 512
 
 def dynamically_init_indexer(**kwargs):
     return dynamically_init_class(__name__, **kwargs)
@@ -35,23 +82,50 @@ class SPIMIIndexer(Indexer):
 
     def __init__(self,
                  posting_threshold,
-                 memory_threshold,
                  token_threshold,
+                 memory_budget_mb=None,
+                 workers=None,
+                 posting_format=None,
+                 positions_storage=None,
+                 pipeline=False,
                  **kwargs):
         # lets suppose that the SPIMIIindex uses the inverted index, so
         # it initializes this type of index
         super().__init__(
-            InvertedIndex(posting_threshold, token_threshold=token_threshold),
+            InvertedIndex(
+                posting_threshold,
+                token_threshold=token_threshold,
+                memory_budget_mb=memory_budget_mb,
+                posting_format=posting_format,
+                positions_storage=positions_storage
+            ),
             **kwargs
         )
 
         self.posting_threshold = posting_threshold
-        self.memory_threshold = memory_threshold if memory_threshold else 75
+        self.memory_budget_mb = memory_budget_mb if memory_budget_mb else DEFAULT_MEMORY_BUDGET_MB
         self.token_threshold = token_threshold if token_threshold else 50000
+        self.workers = workers if workers else 1
+        # number of publications sent to a worker at once (parallel mode only)
+        self.batch_size = 5000
+        # reader -> tokenizer -> inverter stages connected by bounded queues
+        self.pipeline = pipeline
+        # number of publications that go through the pipeline queues at once
+        self.pipeline_batch_size = 256
         self.weight_method = None
         self.kwargs = kwargs
 
-        print("init SPIMIIndexer|", f"{posting_threshold=}, {memory_threshold=}")
+        print(
+            "init SPIMIIndexer|",
+            f"{posting_threshold=}, {memory_budget_mb=}, {workers=}, {posting_format=}, {positions_storage=}, {pipeline=}"
+        )
+
+        # documents get dense sequential ids (0, 1, 2, ...) in the order they are read
+        # doc_pmids[doc_id] is the pmid and pub_length[doc_id] the number of tokens of the document
+        self.doc_pmids = []
+        self.pub_length = array('I')
+        self.pub_total_tokens = 0
+        self.pub_avg_length = 0
 
         if kwargs["tfidf"]["cache_in_disk"]:
             self.weight_method = 'tfidf'
@@ -59,98 +133,32 @@ class SPIMIIndexer(Indexer):
             print(f"Using tfidf - {self.smart}")
         elif kwargs["bm25"]["cache_in_disk"]:
             self.weight_method = 'bm25'
-            self.pub_length = {}
-            self.pub_total_tokens = 0
-            self.pub_avg_length = 0
             print("Using bm25")
 
     def build_index(self, reader, tokenizer, index_output_folder):
         print("Indexing some documents...")
 
         tic = time()
-        n_documents = 0
-        while 1:
-
-            # read publication
-            # pmid, pub = reader.read_next_pub(fields=["title", "abstract"])
-            pmid, pub = reader.read_next_pub()
-            if pmid is None:    # end of file
-                break
-
-            n_documents += 1
-
-            # tokenize publication
-            filtered_terms = tokenizer.tokenize(pub)
-
-            tokens = {}
-
-            # Store tokens term positions
-            for i, token in enumerate(filtered_terms):
-                if token not in tokens:
-                    tokens[token] = { pmid : [i] }
-                else:
-                    tokens[token][pmid] += [i]
-
-            # is there any step we need to give because of the weighting method?
-            if self.weight_method == 'tfidf':
-                if self.smart[0] == 'l':
-                    # Calculate logarithm of term frequency
-                    for token in tokens:
-                        positions = tokens[token][pmid]
-                        term_frequency = len(positions)
-                        tokens[token][pmid] = (1 + log10(term_frequency), positions)    # (tf, positions_list)
-                elif self.smart[0] == 'a':
-                    # Calculate augmented
-                    raise NotImplementedError
-                elif self.smart[0] == 'b':
-                    # Calculate boolean
-                    raise NotImplementedError
-                elif self.smart[0] == 'L':
-                    # Calculate log ave
-                    raise NotImplementedError
-            elif self.weight_method == 'bm25':
-                pub_tokens = 0
-                for token in tokens:
-                    positions = tokens[token][pmid]
-                    term_frequency = len(positions)
-                    tokens[token][pmid] = (term_frequency, positions)    # (tf, positions_list)
-                    pub_tokens += term_frequency
-                self.pub_length[pmid] = pub_tokens
-                self.pub_total_tokens += pub_tokens
-
-            _ = [
-                self._index.add_term(
-                    token,
-                    doc_id,
-                    tf_positions,
-                    index_output_folder=index_output_folder
-                )
-                for token, data in tokens.items()
-                for doc_id, tf_positions in data.items()
-            ] # add terms to index
-
-            mem_percentage = psutil.virtual_memory().percent
-            print(
-                (f"Using {mem_percentage}% of memory | "
-                f"{self._index.block_counter} blocks written"),
-                end="\r"
-            )
-
-            if mem_percentage > self.memory_threshold:
-                self._index.write_to_disk(index_output_folder)
-                self._index.clean_index()
-
-        self._index.write_to_disk(index_output_folder)
-        self._index.clean_index()
+        if self.pipeline:
+            n_documents = self.build_blocks_pipeline(reader, tokenizer, index_output_folder)
+        elif self.workers > 1:
+            n_documents = self.build_blocks_parallel(reader, tokenizer, index_output_folder)
+        else:
+            n_documents = self.build_blocks(reader, tokenizer, index_output_folder)
 
         n_temporary_files = len(self._index.filenames)
 
+        if self.weight_method == 'bm25':
+            self.pub_avg_length = self.pub_total_tokens / n_documents
+
         # now we need to create the final index using all the temporary files
         self._index.merge_blocks(
             index_output_folder,
             n_documents=n_documents,
             weight_method=self.weight_method,
-            kwargs=self.kwargs
+            kwargs=self.kwargs,
+            doc_lengths=self.pub_length,
+            avg_length=self.pub_avg_length
         )
 
         # Write metadata in index.txt file
@@ -199,22 +207,61 @@ class SPIMIIndexer(Indexer):
             f'{index_output_folder}/index.txt', 'user.indexer_token_threshold',
             f'{self._index.token_threshold}'.encode('utf-8')
         )
+        os.setxattr(
+            f'{index_output_folder}/index.txt', 'user.indexer_posting_format',
+            f'{self._index.posting_format}'.encode('utf-8')
+        )
+        os.setxattr(
+            f'{index_output_folder}/index.txt', 'user.indexer_positions_storage',
+            f'{self._index.positions_storage}'.encode('utf-8')
+        )
+
+        # store the publications length as an array of uint32 (indexed by doc id)
+        # and the doc id -> pmid mapping (the pmid of each doc id, one per line)
+        with open(f"{index_output_folder}/{DOC_LENGTHS_FILENAME}", "wb") as f:
+            self.pub_length.tofile(f)
+        with open(f"{index_output_folder}/{DOC_PMIDS_FILENAME}", "w") as f:
+            for pmid in self.doc_pmids:
+                f.write(f"{pmid}\n")
 
         if self.weight_method == 'tfidf':
             os.setxattr(
                 f'{index_output_folder}/index.txt', 'user.indexer_smart',
                 f'{self.smart}'.encode('utf-8')
             )
+            if self.smart[2] == 'u':
+                os.setxattr(
+                    f'{index_output_folder}/index.txt', 'user.indexer_pivot',
+                    f'{self._index.pivot}'.encode('utf-8')
+                )
+                os.setxattr(
+                    f'{index_output_folder}/index.txt', 'user.indexer_slope',
+                    f'{self._index.slope}'.encode('utf-8')
+                )
         elif self.weight_method == 'bm25':
-            # store pub_length dictionary | { pub_id : pub_length }
-            with open(f"{index_output_folder}/pubs_length.txt", "wb") as f:
-                for pmid, pub_len in self.pub_length.items():
-                    f.write(f"{pmid} {pub_len}\n".encode('utf-8'))
-            self.pub_avg_length = self.pub_total_tokens / n_documents
             os.setxattr(
                 f'{index_output_folder}/index.txt', 'user.indexer_pub_avg_length',
                 f'{self.pub_avg_length}'.encode('utf-8')
             )
+            # k1 and b used to compute the max score of every term (term dictionary)
+            os.setxattr(
+                f'{index_output_folder}/index.txt', 'user.indexer_bm25_k1',
+                f'{self.kwargs["bm25"]["k1"]}'.encode('utf-8')
+            )
+            os.setxattr(
+                f'{index_output_folder}/index.txt', 'user.indexer_bm25_b',
+                f'{self.kwargs["bm25"]["b"]}'.encode('utf-8')
+            )
+            # precomputed impacts (computed with the k1 and b above)
+            os.setxattr(
+                f'{index_output_folder}/index.txt', 'user.indexer_bm25_impacts',
+                f'{self._index.impact_format or ""}'.encode('utf-8')
+            )
+            if self._index.impact_format == "uint8":
+                os.setxattr(
+                    f'{index_output_folder}/index.txt', 'user.indexer_bm25_impact_scale',
+                    f'{self._index.impact_scale}'.encode('utf-8')
+                )
 
         toc = time()
 
@@ -222,9 +269,19 @@ class SPIMIIndexer(Indexer):
             f"Indexing finished in {strftime('%H:%M:%S', gmtime(toc-tic))} |",
             f"{self._index.index_size/(1<<20)}mb occupied in disk |",
             f"{n_temporary_files} temporary files |",
-            f"{self._index.n_tokens} tokens"
+            f"{self._index.n_tokens} tokens |",
+            f"{n_documents/(toc-tic):.2f} docs/s with {self.workers} worker(s)"
         )
 
+        # the workers of a parallel build have their own tokenizer (and stem cache)
+        stem_cache_stats = tokenizer.stem_cache_stats()
+        if stem_cache_stats and stem_cache_stats['hits'] + stem_cache_stats['misses']:
+            print(
+                f"Stem cache: {stem_cache_stats['hits']} hits | {stem_cache_stats['misses']} misses |",
+                f"hit rate {stem_cache_stats['hit_rate']:.2f} |",
+                f"{stem_cache_stats['size']}/{stem_cache_stats['max_size']} stems"
+            )
+
         # check if stats file exists
         if not os.path.exists("stats.txt"):
             with open("stats.txt", "w") as stats_file:
@@ -248,6 +305,843 @@ class SPIMIIndexer(Indexer):
             )
 
 
+    def add_document(self, doc_id, pub, tokenizer, index_output_folder):
+        """
+        Tokenizes a publication and adds its postings to the in-memory index
+        doc_id is the dense integer id of the publication (its position in the collection)
+        """
+
+        # tokenize publication
+        self.add_tokens(doc_id, tokenizer.tokenize(pub), index_output_folder)
+
+    def add_tokens(self, doc_id, filtered_terms, index_output_folder):
+        """
+        Adds the postings of a tokenized publication to the in-memory index
+        """
+
+        self.pub_length.append(len(filtered_terms))
+        self.pub_total_tokens += len(filtered_terms)
+
+        tokens = {}
+
+        # Store tokens term positions
+        for i, token in enumerate(filtered_terms):
+            if token not in tokens:
+                tokens[token] = { doc_id : [i] }
+            else:
+                tokens[token][doc_id] += [i]
+
+        # is there any step we need to give because of the weighting method?
+        if self.weight_method == 'tfidf':
+            if self.smart[0] == 'l':
+                # Calculate logarithm of term frequency
+                for token in tokens:
+                    positions = tokens[token][doc_id]
+                    term_frequency = len(positions)
+                    tokens[token][doc_id] = (1 + log10(term_frequency), positions)    # (tf, positions_list)
+            elif self.smart[0] == 'a':
+                # Calculate augmented
+                raise NotImplementedError
+            elif self.smart[0] == 'b':
+                # Calculate boolean
+                raise NotImplementedError
+            elif self.smart[0] == 'L':
+                # Calculate log ave
+                raise NotImplementedError
+        elif self.weight_method == 'bm25':
+            for token in tokens:
+                positions = tokens[token][doc_id]
+                term_frequency = len(positions)
+                tokens[token][doc_id] = (term_frequency, positions)    # (tf, positions_list)
+
+        _ = [
+            self._index.add_term(
+                token,
+                doc_id,
+                tf_positions,
+                index_output_folder=index_output_folder
+            )
+            for token, data in tokens.items()
+            for doc_id, tf_positions in data.items()
+        ] # add terms to index
+
+    def build_blocks(self, reader, tokenizer, index_output_folder):
+        """
+        Single process SPIMI: reads every publication, inverts it and
+        writes sorted blocks to disk. Returns the number of documents read
+        """
+
+        n_documents = 0
+        for pmid, pub in reader:
+
+            self.doc_pmids.append(pmid)
+            self.add_document(n_documents, pub, tokenizer, index_output_folder)
+
+            n_documents += 1
+
+        self._index.write_to_disk(index_output_folder)
+        self._index.clean_index()
+
+        return n_documents
+
+    def build_blocks_parallel(self, reader, tokenizer, index_output_folder):
+        """
+        Multi-process SPIMI: this process reads the collection and sends batches
+        of publications to the workers, which tokenize and invert them and write
+        their own sorted blocks when their share of the memory budget is full.
+        The blocks are sorted by their first doc id, the batches of the workers are
+        interleaved, so the merge sorts the postings of the blocks that overlap
+        (see sort_segments) and the final index is the same that a single process
+        build would produce.
+        Returns the number of documents read
+        """
+
+        context = multiprocessing.get_context("fork")
+        batch_queue = context.Queue(maxsize=2 * self.workers)
+        result_queue = context.Queue()
+
+        workers = [
+            context.Process(
+                target=self.index_worker,
+                args=(worker_number, tokenizer, index_output_folder, batch_queue, result_queue)
+            )
+            for worker_number in range(self.workers)
+        ]
+        for worker in workers:
+            worker.start()
+
+        n_documents = 0
+        batch_number = 0
+        batch = []
+        for pmid, pub in reader:
+
+            self.doc_pmids.append(pmid)
+            batch.append((n_documents, pub))
+            n_documents += 1
+
+            if len(batch) == self.batch_size:
+                self.send_batch(batch_queue, (batch_number, batch), workers)
+                batch_number += 1
+                batch = []
+
+        if batch:
+            self.send_batch(batch_queue, (batch_number, batch), workers)
+
+        # one stop signal per worker
+        for _ in workers:
+            self.send_batch(batch_queue, None, workers)
+
+        # results must be read before joining, otherwise a worker may block on a full pipe
+        blocks = []
+        batches = []
+        for _ in workers:
+            worker_blocks, worker_batches = self.receive(result_queue, workers)
+            blocks += worker_blocks
+            batches += worker_batches
+        for worker in workers:
+            worker.join()
+
+        # (the sort is stable, so the blocks of a worker that start with the same doc keep their order)
+        self._index.filenames = [filename for _, filename in sorted(blocks, key=itemgetter(0))]
+        self._index.block_counter = len(self._index.filenames)
+        for _, pub_length in sorted(batches, key=lambda batch: batch[0]):
+            self.pub_length.extend(pub_length)
+            self.pub_total_tokens += sum(pub_length)
+
+        return n_documents
+
+    def send_batch(self, batch_queue, batch, workers):
+        """
+        Puts a batch in the (bounded) queue of the workers, failing
+        instead of waiting forever if a worker died
+        """
+        while 1:
+            try:
+                batch_queue.put(batch, timeout=1)
+                return
+            except queue.Full:
+                self.check_workers(workers)
+
+    def receive(self, result_queue, workers):
+        """
+        Gets an item that the workers put in a queue, failing instead
+        of waiting forever if a worker died
+        """
+        while 1:
+            try:
+                return result_queue.get(timeout=1)
+            except queue.Empty:
+                self.check_workers(workers)
+                if not any(worker.is_alive() for worker in workers):
+                    # the last item may have arrived after the timeout
+                    try:
+                        return result_queue.get(timeout=1)
+                    except queue.Empty:
+                        raise RuntimeError("The indexing workers exited without sending their results")
+
+    @staticmethod
+    def check_workers(workers):
+        """
+        Stops every worker and raises an error if one of them exited with an error
+        """
+        for worker in workers:
+            if worker.exitcode:
+                for other_worker in workers:
+                    other_worker.terminate()
+                raise RuntimeError(
+                    f"Indexing worker {worker.pid} exited with code {worker.exitcode}"
+                )
+
+    def index_worker(self, worker_number, tokenizer, index_output_folder, batch_queue, result_queue):
+        """
+        Worker process loop. The batches are added to the in-memory index of the worker,
+        which is written to a block (block_<worker>_<n>.txt) when it is over the worker's
+        share of the memory budget. When there are no more batches the list of
+        (first doc id, filename) of its blocks and the list of (batch_number, pub_length)
+        are sent back to the main process
+        """
+
+        # every worker has its own in-memory index, they share the memory budget
+        self._index.memory_budget /= self.workers
+        self._index.block_prefix = f"block_{worker_number}_"
+
+        # first doc id of the block that is being filled
+        first_doc = None
+        first_docs = []
+        batches = []
+        while 1:
+            batch = self.get_from_stage(batch_queue)
+            if batch is None:
+                break
+
+            batch_number, pubs = batch
+            self.pub_length = array('I')
+
+            for doc_id, pub in pubs:
+                if first_doc is None:
+                    first_doc = doc_id
+                n_blocks = len(self._index.filenames)
+                self.add_document(doc_id, pub, tokenizer, index_output_folder)
+                # the index was written while adding the document, the next block starts with it
+                for _ in range(len(self._index.filenames) - n_blocks):
+                    first_docs.append(first_doc)
+                    first_doc = doc_id
+
+            batches.append((batch_number, self.pub_length))
+
+        self._index.write_to_disk(index_output_folder)
+        self._index.clean_index()
+        if len(self._index.filenames) > len(first_docs):
+            first_docs.append(first_doc)
+
+        result_queue.put((list(zip(first_docs, self._index.filenames)), batches))
+
+    @staticmethod
+    def get_from_stage(stage_queue):
+        """
+        Gets an item from the queue of a worker process, the worker exits
+        instead of waiting forever if the main process is gone
+        """
+        while 1:
+            try:
+                return stage_queue.get(timeout=1)
+            except queue.Empty:
+                if not multiprocessing.parent_process().is_alive():
+                    sys.exit(1)
+
+    @staticmethod
+    def put_to_stage(stage_queue, item):
+        """
+        Puts an item in the (bounded) queue of the next stage, the worker
+        exits instead of waiting forever if the main process is gone
+        """
+        while 1:
+            try:
+                stage_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                if not multiprocessing.parent_process().is_alive():
+                    sys.exit(1)
+
+    def build_blocks_pipeline(self, reader, tokenizer, index_output_folder):
+        """
+        Pipelined SPIMI: a reader process decompresses and parses the collection,
+        self.workers tokenizer processes tokenize it and this process inverts the
+        tokenized publications and writes the blocks. The stages exchange batches of
+        publications through bounded queues, so a fast stage waits for the slow one
+        (back-pressure) instead of filling the memory.
+        The batches are inverted in the order they were read, so the index is the same
+        that a single process build would produce.
+        Every stage counts the publications it processed and the time it spent
+        working and waiting for the other stages, which shows the bottleneck.
+        Returns the number of documents read
+        """
+
+        context = multiprocessing.get_context("fork")
+        pub_queue = context.Queue(maxsize=2 * self.workers)
+        token_queue = context.Queue(maxsize=2 * self.workers)
+        stats_queue = context.Queue()
+
+        stages = [
+            context.Process(
+                target=self.read_stage,
+                args=(reader, pub_queue, stats_queue)
+            )
+        ] + [
+            context.Process(
+                target=self.tokenize_stage,
+                args=(tokenizer, pub_queue, token_queue, stats_queue)
+            )
+            for _ in range(self.workers)
+        ]
+        for stage in stages:
+            stage.start()
+
+        # the tokenized batches are received by a thread: a tokenizer killed while it sends
+        # a batch leaves part of it in token_queue and reading it would block forever,
+        # this process only waits (with a timeout) for the batches that were fully received
+        received_queue = queue.Queue(maxsize=2 * self.workers)
+        threading.Thread(
+            target=self.forward_batches, args=(token_queue, received_queue), daemon=True
+        ).start()
+
+        # tokenizers may finish their batches out of order
+        # { batch number : [(pmid, tokens), ...] }
+        pending = {}
+        next_batch = 0
+        n_documents = 0
+        finished_tokenizers = 0
+        busy = 0
+        waiting = 0
+        while finished_tokenizers < self.workers:
+            tick = time()
+            # fails if the reader or a tokenizer died (bad publication, out of memory)
+            batch = self.receive(received_queue, stages)
+            tock = time()
+            waiting += tock - tick
+
+            if batch is None:
+                finished_tokenizers += 1
+                continue
+
+            pending[batch[0]] = batch[1]
+            while next_batch in pending:
+                for pmid, filtered_terms in pending.pop(next_batch):
+                    self.doc_pmids.append(pmid)
+                    self.add_tokens(n_documents, filtered_terms, index_output_folder)
+                    n_documents += 1
+                next_batch += 1
+            busy += time() - tock
+
+        self._index.write_to_disk(index_output_folder)
+        self._index.clean_index()
+
+        stage_stats = [self.receive(stats_queue, stages) for _ in stages]
+        for stage in stages:
+            stage.join()
+
+        # the tokenizers work at the same time, so their throughput is added
+        tokenize_stats = [stats for stats in stage_stats if stats[0] == "tokenize"]
+        stage_stats = [stats for stats in stage_stats if stats[0] == "read"] + [(
+            "tokenize",
+            sum(stats[1] for stats in tokenize_stats),
+            sum(stats[2] for stats in tokenize_stats) / self.workers,
+            sum(stats[3] for stats in tokenize_stats) / self.workers
+        ), ("invert", n_documents, busy, waiting)]
+
+        print()
+        for stage, n_pubs, stage_busy, stage_waiting in stage_stats:
+            print(
+                f"Pipeline {stage} stage |",
+                f"{n_pubs} docs |",
+                f"{n_pubs/stage_busy if stage_busy else 0:.2f} docs/s while working |",
+                f"{stage_busy:.2f}s working |",
+                f"{stage_waiting:.2f}s waiting"
+            )
+
+        return n_documents
+
+    def forward_batches(self, token_queue, received_queue):
+        """
+        Moves the tokenized batches from the tokenizers' queue to a queue of this process,
+        until every tokenizer sent its stop signal (runs in a thread of the main process)
+        """
+        finished_tokenizers = 0
+        while finished_tokenizers < self.workers:
+            batch = token_queue.get()
+            if batch is None:
+                finished_tokenizers += 1
+            received_queue.put(batch)
+
+    def read_stage(self, reader, pub_queue, stats_queue):
+        """
+        Pipeline stage (process) that reads the publications and sends them in batches
+        to the tokenizers, followed by one stop signal per tokenizer
+        """
+
+        n_pubs = 0
+        busy = 0
+        waiting = 0
+        batch_number = 0
+        while 1:
+            tick = time()
+            batch = reader.read_pubs(self.pipeline_batch_size)
+            tock = time()
+            busy += tock - tick
+
+            if not batch:   # end of the collection
+                break
+
+            self.put_to_stage(pub_queue, (batch_number, batch))
+            batch_number += 1
+            n_pubs += len(batch)
+            waiting += time() - tock
+
+        for _ in range(self.workers):
+            self.put_to_stage(pub_queue, None)
+
+        stats_queue.put(("read", n_pubs, busy, waiting))
+
+    def tokenize_stage(self, tokenizer, pub_queue, token_queue, stats_queue):
+        """
+        Pipeline stage (process) that tokenizes batches of publications
+        """
+
+        n_pubs = 0
+        busy = 0
+        waiting = 0
+        while 1:
+            tick = time()
+            batch = self.get_from_stage(pub_queue)
+            tock = time()
+            waiting += tock - tick
+
+            if batch is None:
+                break
+
+            batch_number, pubs = batch
+            tokenized = [(pmid, tokenizer.tokenize(pub)) for pmid, pub in pubs]
+            n_pubs += len(pubs)
+
+            tick = time()
+            busy += tick - tock
+            self.put_to_stage(token_queue, (batch_number, tokenized))
+            waiting += time() - tick
+
+        self.put_to_stage(token_queue, None)
+        stats_queue.put(("tokenize", n_pubs, busy, waiting))
+
+
+class TermPostings:
+    """
+    Postings of a term in the in-memory (SPIMI) index, kept in compact buffers
+    instead of python objects: the doc ids (uint32), the weights (tf as uint32 or
+    tfidf weight as double) and the varint packed positions of every posting
+    (<number of positions> <position gap> * number of positions, see encode_positions)
+    """
+
+    __slots__ = ("doc_ids", "weights", "positions")
+
+    def __init__(self, weight_typecode):
+        self.doc_ids = array('I')
+        self.weights = array(weight_typecode)
+        self.positions = bytearray()
+
+    def add(self, doc_id, weight, positions):
+        """
+        Appends a posting, returns the number of bytes it takes
+        """
+        size = len(self.positions)
+        self.doc_ids.append(doc_id)
+        self.weights.append(weight)
+        encode_positions(positions, self.positions)
+        return self.doc_ids.itemsize + self.weights.itemsize + len(self.positions) - size
+
+    def __str__(self):
+        """
+        Postings in the temporary block format: pmid:tf:[<positions>];pmid:tf:[<positions>];...
+        """
+        data = self.positions
+        # when every number of positions and gap fits in a single byte (most terms)
+        # the positions are the running sum of a slice of the buffer
+        single_bytes = max(data) < 0x80
+
+        postings = []
+        offset = 0
+        for doc_id, weight in zip(self.doc_ids, self.weights):
+            if single_bytes:
+                tf = data[offset]
+                positions = accumulate(data[offset + 1:offset + 1 + tf])
+                offset += 1 + tf
+            else:
+                positions, offset = decode_positions(data, offset)
+            postings.append(f"{doc_id}:{weight}:[{','.join(map(str, positions))}]")
+        return ';'.join(postings)
+
+
+class BlockReader:
+    """
+    Buffered sequential reader over a temporary block file written by
+    InvertedIndex.write_to_disk. Iterating over it yields (term, block_number, postings)
+    tuples, which is what the k-way merge in InvertedIndex.merge_blocks consumes
+    """
+
+    # read/write buffer used for block files during the merge
+    buffer_size = 1 << 20
+
+    def __init__(self, filename, block_number):
+        self.filename = filename
+        self.block_number = block_number
+
+    def __iter__(self):
+        with open(self.filename, "rb", buffering=self.buffer_size) as block:
+            for line in block:
+                term, postings = line.decode("utf-8").rstrip("\n").split(" ", 1)
+                yield term, self.block_number, postings
+
+
+class TermDictionary:
+    """
+    Sorted term dictionary written by InvertedIndex.merge_blocks.
+    For every term it stores the final block that holds its postings and the
+    byte offset and length of the postings inside that block, so a lookup is a
+    binary search over the (memory-mapped) dictionary plus a single seek/read.
+
+    Every entry also holds an upper bound of the score of the term in any document
+    (BM25 with the k1 and b used by the indexer, 0 for other weight methods) and
+    the offset of its block max scores in block_max.bin, used by the dynamic
+    pruning (WAND and Block-Max WAND) of BM25Ranking, and the offset of its
+    skip pointers in skip_pointers.bin.
+
+    File layout:
+        <n_terms: uint32>
+        <entries: n_terms * (term offset, term length, block, postings offset, postings length,
+                             max score, block max offset, skip pointers offset)>
+        <terms: utf-8 terms concatenated in sorted order>
+    """
+
+    filename = "term_dictionary.bin"
+
+    header = struct.Struct("<I")
+    entry = struct.Struct("<QHIQIdQQ")
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.n_terms = self.header.unpack_from(self.data, 0)[0]
+        self.terms_offset = self.header.size + self.n_terms * self.entry.size
+
+    def __len__(self):
+        return self.n_terms
+
+    @classmethod
+    def write(cls, path, entries):
+        """
+        entries: sorted list of (term, block number, postings offset, postings length,
+        max score, block max offset, skip pointers offset)
+        """
+        terms = bytearray()
+        with open(path, "wb") as dictionary_file:
+            dictionary_file.write(cls.header.pack(len(entries)))
+            for term, *locations in entries:
+                term = term.encode("utf-8")
+                dictionary_file.write(cls.entry.pack(len(terms), len(term), *locations))
+                terms += term
+            dictionary_file.write(terms)
+
+    def get_term(self, position):
+        term_offset, term_length = self.entry.unpack_from(
+            self.data, self.header.size + position * self.entry.size
+        )[:2]
+        start = self.terms_offset + term_offset
+        return self.data[start:start + term_length]
+
+    def find(self, token):
+        """
+        Binary search for the token
+        Returns (block number, postings offset, postings length, max score, block max offset,
+        skip pointers offset) or None
+        """
+        token = token.encode("utf-8")
+
+        low = 0
+        high = self.n_terms - 1
+        while low <= high:
+            mid = (high + low) // 2
+            term = self.get_term(mid)
+
+            if term < token:
+                low = mid + 1
+            elif term > token:
+                high = mid - 1
+            else:
+                return self.entry.unpack_from(
+                    self.data, self.header.size + mid * self.entry.size
+                )[2:]
+
+        return None
+
+
+class PostingCursor:
+    """
+    Cursor over the sorted doc ids of a posting list, used by the boolean retrieval.
+    The doc ids are decoded one block of SKIP_INTERVAL postings at a time and the
+    skip pointers (last doc id of every block) let advance() jump over the blocks
+    that can't hold the target, so the intersection of a rare and a common term
+    only decodes a few blocks of the common one
+    """
+
+    def __init__(self, n_postings, skip_last_docs, load_block):
+        self.n_postings = n_postings
+        self.skip_last_docs = skip_last_docs
+        # function that returns the doc ids of a block
+        self.load_block = load_block
+
+        self.block = 0
+        self.block_doc_ids = None
+        self.position = 0
+
+    def __len__(self):
+        return self.n_postings
+
+    def doc_ids(self):
+        """
+        Decodes every doc id of the posting list
+        """
+        doc_ids = []
+        for block in range(len(self.skip_last_docs)):
+            doc_ids += self.load_block(block)
+        return doc_ids
+
+    def advance(self, target):
+        """
+        Moves the cursor to the first doc id >= target (targets must not decrease)
+        Returns that doc id or None if the posting list has no such doc id
+        """
+
+        block = bisect_left(self.skip_last_docs, target, self.block)
+        if block == len(self.skip_last_docs):
+            self.block = block
+            return None
+
+        if block != self.block or self.block_doc_ids is None:
+            self.block = block
+            self.block_doc_ids = self.load_block(block)
+            self.position = 0
+
+        # the last doc id of the block is >= target
+        self.position = bisect_left(self.block_doc_ids, target, self.position)
+        return self.block_doc_ids[self.position]
+
+
+class ScoredPostingCursor(PostingCursor):
+    """
+    PostingCursor that also decodes the weight of every posting of a bm25 index (its tf
+    or its impact, like search_token), used by the WAND rankers.
+    load_block returns the doc ids and the weights of a block and doc is the doc id
+    where the cursor is (None before the first advance and once it is exhausted).
+    After a shallow_advance doc is only a lower bound of it (shallow is set), the
+    block where the cursor lands is decoded by the next advance
+    """
+
+    def __init__(self, n_postings, skip_last_docs, load_block):
+        super().__init__(n_postings, skip_last_docs, load_block)
+        self.block_weights = None
+        self.doc = None
+        self.shallow = False
+
+    def doc_ids(self):
+        doc_ids = []
+        for block in range(len(self.skip_last_docs)):
+            doc_ids += self.load_block(block)[0]
+        return doc_ids
+
+    def advance(self, target):
+        block = bisect_left(self.skip_last_docs, target, self.block)
+        if block == len(self.skip_last_docs):
+            self.block = block
+            self.doc = None
+            return None
+
+        if block != self.block or self.block_doc_ids is None:
+            self.block = block
+            self.block_doc_ids, self.block_weights = self.load_block(block)
+            self.position = 0
+
+        self.position = bisect_left(self.block_doc_ids, target, self.position)
+        self.doc = self.block_doc_ids[self.position]
+        self.shallow = False
+        return self.doc
+
+    def shallow_advance(self, target):
+        """
+        Same as advance, but nothing is decoded: doc becomes target (a lower bound of
+        the doc id where the cursor is), or None if the posting list has no doc id >= target
+        """
+
+        if self.doc is not None and target <= self.doc:
+            return self.doc
+
+        if target > self.skip_last_docs[-1]:
+            self.doc = None
+            return None
+
+        self.doc = target
+        self.shallow = True
+        return self.doc
+
+    def next(self):
+        """
+        Moves the cursor to the next posting
+        Returns its doc id or None if the posting list has no more postings
+        """
+
+        self.position += 1
+        if self.position < len(self.block_doc_ids):
+            self.doc = self.block_doc_ids[self.position]
+            return self.doc
+        return self.advance(self.doc + 1)
+
+    def weight(self):
+        """
+        Returns the weight of the posting where the cursor is
+        """
+        return self.block_weights[self.position]
+
+
+class PostingListCache:
+    """
+    Size bounded LRU cache of posting lists, used by InvertedIndexSearcher.
+    A posting list is kept in a single compact form (see compact), whose size is
+    the size of its buffers, and the least recently used lists are evicted while
+    the cache is over its budget
+    """
+
+    def __init__(self, max_size_mb):
+        self.max_size = int(max_size_mb * (1<<20)) if max_size_mb else 0
+        self.size = 0
+
+        # { token : (compact posting list, size) }, ordered from least to most recently used
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, token):
+        """
+        Returns (True, compact posting list) if the token is cached and (False, None) otherwise
+        """
+        if token in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(token)
+            return True, self.entries[token][0]
+
+        self.misses += 1
+        return False, None
+
+    def put(self, token, compact_list):
+        if not self.max_size:
+            return
+
+        size = self.estimate_size(compact_list)
+        if size > self.max_size:
+            # it would evict everything else and still not fit
+            return
+
+        if token in self.entries:
+            self.size -= self.entries.pop(token)[1]
+
+        self.entries[token] = (compact_list, size)
+        self.size += size
+
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    @staticmethod
+    def compact(posting_list):
+        """
+        Converts a decoded posting list {doc_id: (weight, positions)} into
+        (doc ids, weights, positions, position ends): the doc ids and weights are
+        numpy arrays, which are used as they are by the vectorized rankers, and the
+        positions of all the postings are concatenated in a single buffer
+        - text postings: a string, position ends are the end of each posting's string
+        - separate positions: an array with the offset of each posting (no ends)
+        - binary postings: an array with every position, ends are the end of each posting's positions
+        """
+        if not posting_list:
+            return None
+
+        doc_ids = np.fromiter(posting_list.keys(), dtype=np.int64, count=len(posting_list))
+        weights = np.fromiter(
+            (weight for weight, _ in posting_list.values()),
+            dtype=np.float64, count=len(posting_list)
+        )
+
+        positions = [positions for _, positions in posting_list.values()]
+        if isinstance(positions[0], str):
+            return doc_ids, weights, "".join(positions), array('I', accumulate(map(len, positions)))
+        if isinstance(positions[0], int):
+            return doc_ids, weights, array('Q', positions), None
+        return (
+            doc_ids, weights,
+            array('I', (position for doc_positions in positions for position in doc_positions)),
+            array('I', accumulate(map(len, positions)))
+        )
+
+    @staticmethod
+    def expand(compact_list):
+        """
+        Rebuilds the posting list {doc_id: (weight, positions)} from its compact form
+        """
+        if compact_list is None:
+            return None
+
+        doc_ids, weights, positions, ends = compact_list
+        if ends is None:
+            return dict(zip(doc_ids.tolist(), zip(weights.tolist(), positions.tolist())))
+
+        starts = [0]
+        starts += ends[:-1]
+        if isinstance(positions, str):
+            doc_positions = [positions[start:end] for start, end in zip(starts, ends)]
+        else:
+            doc_positions = [positions[start:end].tolist() for start, end in zip(starts, ends)]
+        return dict(zip(doc_ids.tolist(), zip(weights.tolist(), doc_positions)))
+
+    @staticmethod
+    def estimate_size(compact_list):
+        """
+        Number of bytes of the buffers of a compact posting list (see compact)
+        """
+        if compact_list is None:
+            return sys.getsizeof(compact_list)
+
+        doc_ids, weights, positions, ends = compact_list
+        size = doc_ids.nbytes + weights.nbytes
+        if isinstance(positions, str):
+            # the positions of the text postings are ascii
+            size += len(positions)
+        else:
+            size += positions.itemsize * len(positions)
+        if ends is not None:
+            size += ends.itemsize * len(ends)
+        return size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'size_mb': self.size / (1<<20),
+            'max_size_mb': self.max_size / (1<<20)
+        }
+
+
 class BaseIndex:
 
     def __init__(self, posting_threshold, **kwargs):
@@ -255,14 +1149,28 @@ class BaseIndex:
         self._posting_threshold = posting_threshold
 
         self.token_threshold = kwargs['token_threshold'] if kwargs['token_threshold'] else 50000
+        # the in-memory index is written to a block when its estimated size goes over the budget
+        memory_budget_mb = kwargs.get('memory_budget_mb') or DEFAULT_MEMORY_BUDGET_MB
+        self.memory_budget = memory_budget_mb * (1<<20)
+        # number of postings and estimated size (bytes) of the in-memory index,
+        # updated by add_term so the flush decision doesn't go through the postings
+        self.n_postings = 0
+        self.memory_usage = 0
+        # format of the final index files: text (<doc>:<weight>:[<positions>]) or binary (see compression.py)
+        self.posting_format = kwargs.get('posting_format') or "text"
+        # positions stored in the postings (inline) or in their own file (separate)
+        self.positions_storage = kwargs.get('positions_storage') or "inline"
 
         self.block_counter = 0
+        # temporary block files are named <block_prefix><block_counter>.txt
+        self.block_prefix = "block_"
 
         self.filenames = []
 
         self.index_size = 0
         self.n_tokens = 0
         self.merging_time = 0
+        self.merging_throughput = 0
 
     def add_term(self, term, doc_id, *args, **kwargs):
         # check if postings list size > postings_threshold
@@ -282,10 +1190,12 @@ class BaseIndex:
             self.posting_list[doc_id].append(term)
 
     def print_statistics(self):
-        print(f"{self.index_size/(1<<20)}mb occupied in disk | {self.n_tokens} tokens | merge took {self.merging_time} seconds")
+        print(f"{self.index_size/(1<<20)}mb occupied in disk | {self.n_tokens} tokens | merge took {self.merging_time} seconds ({self.merging_throughput:.2f} MB/s)")
 
     def clean_index(self):
         self.posting_list = {}
+        self.n_postings = 0
+        self.memory_usage = 0
 
     # Apenas escreve o indice em disco de forma ordenada
     def write_to_disk(self, folder):
@@ -298,7 +1208,7 @@ class BaseIndex:
         return n_documents
 
     @classmethod
-    def load_from_disk(cls, path_to_folder:str):
+    def load_from_disk(cls, path_to_folder:str, **kwargs):
         if not os.path.exists(f"{path_to_folder}/index.txt"):
             raise FileNotFoundError
 
@@ -309,7 +1219,8 @@ class BaseIndex:
         if index_classname == "InvertedIndex":
             return InvertedIndexSearcher(
                 path_to_folder=path_to_folder,
-                posting_threshold=0
+                posting_threshold=0,
+                **kwargs
             )
 
         raise NotImplementedError
@@ -328,15 +1239,23 @@ class InvertedIndex(BaseIndex):
     def __init__(self, posting_threshold, **kwargs):
         super().__init__(posting_threshold, **kwargs)
 
+        # pivoted unique normalization (lnu) parameters
+        # we use the slope value ranked as best in the paper
+        self.pivot = None
+        self.slope = 0.3
+        # bm25 impacts stored in the postings (None, "double" or "uint8") and quantization scale
+        self.impact_format = None
+        self.impact_scale = None
+
     def add_term(self, term, doc_id, *args, **kwargs):
-        # check if postings list size > postings_threshold
+        # check if the number of postings > postings_threshold, the number of
+        # terms > token_threshold or the estimated size > memory budget
         if (
-            (self._posting_threshold and
-            sum(
-                [v for data in self.posting_list.values() for v in data.values()]
-            ) > self._posting_threshold)
+            (self._posting_threshold and self.n_postings > self._posting_threshold)
             or
             (self.token_threshold and len(self.posting_list) > self.token_threshold)
+            or
+            self.memory_usage > self.memory_budget
         ):
             # if 'index_output_folder' not in kwargs or 'filename' not in kwargs:
             if 'index_output_folder' not in kwargs:
@@ -344,34 +1263,92 @@ class InvertedIndex(BaseIndex):
                     "index_output_folder is required in kwargs in order to store the index on disk"
                 )
 
+            print(
+                (f"Writing block {self.block_counter} | {self.n_postings} postings | "
+                f"{self.memory_usage / (1<<20):.1f} MB (estimated) in memory"),
+                end="\r"
+            )
             self.write_to_disk(kwargs['index_output_folder'])
             self.clean_index()
 
-        # term: [doc_id1, doc_id2, doc_id3, ...]
-        if term not in self.posting_list:
-            self.posting_list[term] = { doc_id : args[0] }
-        else:
-            self.posting_list[term][doc_id] = args[0]
+        # term: TermPostings with the (doc_id, tf, positions) of every posting
+        weight, positions = args[0]
+        postings = self.posting_list.get(term)
+        if postings is None:
+            postings = self.posting_list[term] = TermPostings('d' if isinstance(weight, float) else 'I')
+            self.memory_usage += TERM_MEMORY + sys.getsizeof(term)
+
+        self.n_postings += 1
+        self.memory_usage += postings.add(doc_id, weight, positions)
 
     # Apenas escreve o indice em disco de forma ordenada
     def write_to_disk(self, folder):
 
+        # nothing to write (the index was flushed right before)
+        if not self.posting_list:
+            return
+
         if not os.path.exists(folder):
-            os.makedirs(folder)
+            os.makedirs(folder, exist_ok=True)
 
         # First, we need to sort the index by key
         sorted_index = {k: self.posting_list[k] for k in sorted(self.posting_list)}
 
         # Then we write it to disk
-        f = open(f"{folder}/block_{self.block_counter}.txt", "wb")
-        self.filenames.append(f"{folder}/block_{self.block_counter}.txt")
-        for term, posting in sorted_index.items():
+        f = open(f"{folder}/{self.block_prefix}{self.block_counter}.txt", "wb")
+        self.filenames.append(f"{folder}/{self.block_prefix}{self.block_counter}.txt")
+        for term, postings in sorted_index.items():
             # term pmid:tf:[<positions>];pmid:tf:[<positions>];...
-            f.write(f"{term} {';'.join([ str(pmid) + ':' + str(tf_positions[0]) + ':[' + ','.join(map(str, tf_positions[1])) + ']' for pmid, tf_positions in posting.items()])}\n".encode("utf-8"))
+            f.write(f"{term} {postings}\n".encode("utf-8"))
         f.close()
         self.block_counter += 1
 
-    def merge_blocks(self, folder, n_documents, weight_method, kwargs):
+    def merge_temporary_blocks(self, filenames, merged_filename):
+        """
+        Merges temporary blocks into a single temporary block (same format), the
+        postings of a term are concatenated in the order of the blocks (see sort_segments).
+        The merged blocks are deleted, returns the name of the new block
+        """
+
+        readers = [
+            BlockReader(filename, block_number)
+            for block_number, filename in enumerate(filenames)
+        ]
+
+        with open(merged_filename, "wb", buffering=BlockReader.buffer_size) as merged_block:
+            for term, lines in groupby(heapq.merge(*readers), key=itemgetter(0)):
+                postings = ";".join(self.sort_segments([postings for _, _, postings in lines]))
+                merged_block.write(f"{term} {postings}\n".encode("utf-8"))
+
+        for filename in filenames:
+            os.remove(filename)
+
+        return merged_filename
+
+    @staticmethod
+    def sort_segments(segments):
+        """
+        Returns the postings of a term in each block (segments, in the order of the blocks)
+        in doc id order. Blocks hold consecutive documents, so the segments usually follow
+        each other and are returned as they are, but the blocks of the parallel indexing
+        workers have interleaved batches of documents and then the postings are sorted
+        """
+
+        last_doc = -1
+        for segment in segments:
+            first_doc = int(segment[:segment.index(":")])
+            if first_doc <= last_doc:
+                break
+            last_posting = segment[segment.rfind(";") + 1:]
+            last_doc = int(last_posting[:last_posting.index(":")])
+        else:
+            return segments
+
+        postings = [posting for segment in segments for posting in segment.split(";")]
+        postings.sort(key=lambda posting: int(posting[:posting.index(":")]))
+        return [";".join(postings)]
+
+    def merge_blocks(self, folder, n_documents, weight_method, kwargs, doc_lengths=None, avg_length=None):
         """
         During the indexing process, we will create a lot of blocks
         and we will need to merge them in order to create a final index
@@ -380,31 +1357,51 @@ class InvertedIndex(BaseIndex):
 
         print("Merging blocks...")
 
-        # We will iterate over the files containing the blocks
-        # and we will merge them by reading the first line of each file
-        # and then we will compare them and append the smallest one
-        # (alphabetically) to the final block files (after merging)
-        # and we will read the next line of the file that we appended
-        # we will do this until we reach the end of all the files
+        # This is a k-way merge (external sort): every temporary block is read
+        # sequentially by a buffered BlockReader and heapq.merge keeps a heap with
+        # the current line of each block, so choosing the next term costs
+        # O(log blocks). Lines with the same term are sorted by the block number,
+        # which keeps the postings in the order the documents were read (the blocks
+        # are sorted by their first document, see sort_segments for the overlapping ones).
+        # The postings of a term are streamed to the final block file as they
+        # come from the temporary blocks, without building the whole posting string:
+        # only the doc ids and weights are extracted (bm25 scores, skip pointers and
+        # block max scores) unless the postings are written in another form.
 
-        # when this variable is equal to the number of files,
-        # it means we have already read all the files
-        files_ended = 0
+        tic = time()
 
-        # We will create a file object for each file
-        files = [open(filename, "rb") for filename in self.filenames]
+        # bytes read from the temporary blocks (used to report the merge throughput)
+        blocks_size = sum(os.path.getsize(filename) for filename in self.filenames)
+
+        # too many blocks to be opened at once: consecutive groups of MERGE_FAN_IN
+        # blocks are merged into one (which keeps the order of the postings) until
+        # the remaining blocks can be merged together
+        merge_pass = 0
+        while len(self.filenames) > MERGE_FAN_IN:
+            self.filenames = [
+                self.merge_temporary_blocks(
+                    self.filenames[start:start + MERGE_FAN_IN],
+                    f"{folder}/merged_{merge_pass}_{start // MERGE_FAN_IN}.txt"
+                )
+                for start in range(0, len(self.filenames), MERGE_FAN_IN)
+            ]
+            merge_pass += 1
 
-        # We will read the first line of each file
-        lines = [file.readline().decode("utf-8").strip() for file in files]
+        readers = [
+            BlockReader(filename, block_number)
+            for block_number, filename in enumerate(self.filenames)
+        ]
+        merged_lines = heapq.merge(*readers)
 
         # each time we create a new block, we will increment this variable
         final_block_counter = 0
-        # We will create a file object for the final block file
-        final_block_file = open(f"{folder}/final_block_{final_block_counter}.txt", "w")
+        final_block_file = None
+        extension = "bin" if self.posting_format == "binary" else "txt"
 
         # This variable will hold the first term in a block
         # so we can use it to create the index file
         first_term = None
+        last_term = None
 
         # number of lines in a block
         block_lines = 0
@@ -415,11 +1412,7 @@ class InvertedIndex(BaseIndex):
         # n_tokens in index
         n_tokens = 0
 
-        # clean index.txt
-        f = open(f"{folder}/index.txt", "w")
-        f.close()
-
-        tic = time()
+        index_file = open(f"{folder}/index.txt", "w")
 
         # if we are using weight methods we may want to perform some actions during merge
         func = None
@@ -432,157 +1425,345 @@ class InvertedIndex(BaseIndex):
                 # Calculate augmented
                 raise NotImplementedError
 
-        recent_term = None
-        recent_postings = None
-
-        current_term = None
-
-        doc_index = {}
-
-        while files_ended < len(files):
-
-            min_index = lines.index(min(lines))
-            line = lines[min_index]
-
-            #print(f"Reading line {line} | {files_ended/len(files) * 100}%", end="\r")
-            current_term = line.split(" ", 1)[0]
-            current_postings = line.split(" ", 1)[1]
-
-            # We will update the first term if needed
-            first_term = current_term if first_term is None else first_term
-
-            if current_term != recent_term:
-
-                # if func is none at this point, then we may assume that the 
-                # document frequency chosen is the no (n) one
-                posting_list = ""
-                if recent_term and func is not None:
-                    # merge_line is "<term> <doc1>:<term_frequency>,<doc2>:<term_frequency>,..."
-                    # we want tfidf, so we have to multiply tf with idf
-
-                    idf = func(len(recent_postings.split(";")))
-                    for posting in recent_postings.split(";"):
-                        posting_data = posting.split(":")
-                        posting_list += f"{posting_data[0]}:{float(posting_data[1]) * idf}:{str(posting_data[2])};"
-                    posting_list = posting_list[:-1]
-                else:
-                    posting_list = recent_postings
-
-                # normalization calcs
-                if recent_term and weight_method == "tfidf":
-                    if kwargs["tfidf"]["smart"][2] == 'c':
-                        for posting in recent_postings.split(";"):
-                            doc_id = posting.split(':')[0]
-                            weight = posting.split(':')[1]
-                            if doc_id not in doc_index:
-                                doc_index[doc_id] = 0
-                            doc_index[doc_id] += float(weight) ** 2
-                    elif kwargs["tfidf"]["smart"][2] == 'u':
-                        for posting in recent_postings.split(";"):
-                            # in the end we want to know how many unique terms are in each doc
-                            doc_id = posting.split(':')[0]
-                            if doc_id not in doc_index:
-                                doc_index[doc_id] = 0
-                            doc_index[doc_id] += 1
-
-                final_block_file.write(f"{recent_term} {posting_list}\n")
-
-                block_lines += 1
-                n_tokens += 1
-
-                # We are building blocks of files and an index file
-                # We will create a new block file when the number of lines in
-                # the current block file is greater than the token_threshold
-
-                if block_lines >= self.token_threshold:
-
-                    print(
-                        (f"Block {final_block_counter} finished | " +
-                        f"first_term={first_term} and recent_term={recent_term}"),
-                        end="\r"
-                    )
-
-                    # We have to update the index file
-                    # We will write the first and last term of the block and the block's filename
-                    with open(f"{folder}/index.txt", "a") as index_file:
-                        index_file.write(
-                            f"{first_term} {recent_term} {folder}/final_block_{final_block_counter}.txt\n"
-                        )
-
-                    # Close the actual block file
-                    final_block_file.close()
-
-                    # Add the size of the block file to the index size
-                    index_size += os.path.getsize(f"{folder}/final_block_{final_block_counter}.txt")
-
-                    # Create a new block file
-                    final_block_counter += 1
-                    final_block_file = open(
-                        f"{folder}/final_block_{final_block_counter}.txt", "w"
-                    )
-
-                    # We need to reset the variables
-                    first_term = None
-                    block_lines = 0
-
-                # Process new term (current_term)
-                recent_term = current_term
-                recent_postings = current_postings
-
-            elif current_term:
-                # Merge postings list while current_term = recent_term
-                recent_postings += f";{current_postings}"
-
-            lines[min_index] = files[min_index].readline().decode('utf-8')[:-1]
-
-            if lines[min_index] is None or lines[min_index] == "":
-                files[min_index].close()
-                files.pop(min_index)
-                lines.pop(min_index)
-                files_ended += 1
-
-        # We have to update the index file
-        # We will write the first and last term of the block and the block's filename
-        with open(f"{folder}/index.txt", "a") as index_file:
-            index_file.write(f"{first_term} {current_term}" \
-                f" {folder}/final_block_{final_block_counter}.txt\n")
+        # bm25 max score of a term and of each block of its postings (upper bounds used
+        # by WAND and Block-Max WAND), needs the length of the documents
+        block_max_file = None
+        block_max_offset = 0
+        if weight_method == "bm25":
+            k1 = kwargs["bm25"]["k1"]
+            b = kwargs["bm25"]["b"]
+            block_max_file = open(f"{folder}/{BLOCK_MAX_FILENAME}", "wb")
+
+            # the final bm25 impact of every posting can be stored instead of the tf,
+            # as a double or quantized to 8 bits (impact * impact_scale)
+            if kwargs["bm25"].get("impacts"):
+                self.impact_format = "uint8" if kwargs["bm25"].get("quantize") else "double"
+                # the scale maps the largest possible impact, idf(df=1) * (k1 + 1), to 255
+                self.impact_scale = 255 / (max(log10(n_documents), 1e-6) * (k1 + 1))
+
+        skip_pointers_file = open(f"{folder}/{SKIP_POINTERS_FILENAME}", "wb")
+        skip_pointers_offset = 0
+
+        # separate positions: the positions are only read by the searcher when
+        # they are needed (boost and phrases), so they are kept apart from the postings
+        positions_file = None
+        positions_file_offset = 0
+        if self.positions_storage == "separate":
+            positions_file = open(
+                f"{folder}/{POSITIONS_FILENAME}", "wb", buffering=BlockReader.buffer_size
+            )
+
+        # tfidf normalization: sum of the squared weights (c) or number of unique terms (u)
+        # of every document, indexed by doc id
+        doc_index = None
+        if weight_method == "tfidf" and kwargs["tfidf"]["smart"][2] in ('c', 'u'):
+            doc_index = np.zeros(n_documents, dtype=np.float64 if kwargs["tfidf"]["smart"][2] == 'c' else np.int64)
+
+        # bm25 length normalization of every document, same formula as BM25Ranking
+        length_norms = None
+        if weight_method == "bm25":
+            length_norms = k1 * ( (1 - b) + b * (np.frombuffer(doc_lengths, dtype=np.uint32) / avg_length) )
+
+        # the postings of a term only have to be split into their fields when they are
+        # written differently from the temporary blocks (tfidf weights, bm25 impacts,
+        # positions file or binary format), otherwise they are copied as they are
+        rewrite = self.posting_format == "binary" or positions_file is not None or \
+            func is not None or self.impact_format is not None
+
+        # (term, final block number, postings offset, postings length, max score,
+        # block max offset, skip pointers offset) of every term,
+        # written to the term dictionary at the end of the merge
+        dictionary_entries = []
+
+        for term, lines in groupby(merged_lines, key=itemgetter(0)):
+
+            # postings of the term in each temporary block, in doc id order
+            segments = self.sort_segments([postings for _, _, postings in lines])
+
+            if final_block_file is None:
+                final_block_file = open(
+                    f"{folder}/final_block_{final_block_counter}.{extension}", "wb",
+                    buffering=BlockReader.buffer_size
+                )
+                # number of bytes written to the current final block
+                block_offset = 0
+                first_term = term
+
+            # doc id and weight (tf for bm25) of every posting
+            doc_ids = array('I')
+            weights = []
+            if rewrite:
+                # posting = [<doc>, <weight>, <positions>]
+                postings = [
+                    posting.split(":", 2) for segment in segments for posting in segment.split(";")
+                ]
+                doc_ids.extend(int(doc_id) for doc_id, _, _ in postings)
+                weights = [weight for _, weight, _ in postings]
+            else:
+                postings = None
+                # length of every posting of the segments (text skip offsets)
+                posting_lengths = []
+                for segment in segments:
+                    segment_doc_ids, segment_weights = zip(*POSTING_FIELDS.findall(segment))
+                    doc_ids.extend(map(int, segment_doc_ids))
+                    weights += segment_weights
+                    posting_lengths += map(len, segment.split(";"))
+
+            n_postings = len(doc_ids)
+            doc_ids_array = np.frombuffer(doc_ids, dtype=np.uint32)
+            # offset (in the postings of the term) of every SKIP_INTERVAL-th posting
+            skip_offsets = []
+
+            # bm25 score of every posting, same formula as BM25Ranking.calculate_bm25
+            # (the bm25 weight is the tf)
+            scores = None
+            impacts = None
+            if weight_method == "bm25":
+                idf = log10(n_documents/n_postings)
+                tfs = np.fromiter(map(int, weights), dtype=np.float64, count=n_postings)
+                scores = idf * ( (tfs * (k1 + 1)) / (tfs + length_norms[doc_ids_array]) )
+
+                if self.impact_format == "uint8":
+                    impacts = np.minimum(np.round(scores * self.impact_scale), 255)
+                    # the searcher sums the dequantized impacts, so the bounds use them too
+                    scores = impacts / self.impact_scale
+                    impacts = impacts.astype(np.int64).tolist()
+                elif self.impact_format == "double":
+                    impacts = scores.tolist()
+
+            # the positions are only parsed when they are binary encoded
+            positions_lists = None
+            if self.posting_format == "binary" or positions_file is not None:
+                positions_lists = [
+                    list(map(int, positions[1:-1].split(",")))
+                    for _, _, positions in postings
+                ]
+
+            # offset of the positions of every posting in the positions file
+            positions_offsets = None
+            if positions_file is not None:
+                positions_offsets = []
+                positions_data = bytearray()
+                for positions in positions_lists:
+                    positions_offsets.append(positions_file_offset + len(positions_data))
+                    encode_positions(positions, positions_data)
+                positions_file.write(positions_data)
+                positions_file_offset += len(positions_data)
+
+            if self.posting_format == "binary":
+                # doc ids are gap encoded, blocks are merged in the order the documents
+                # were read, so the postings are already sorted by doc id
+                # weights are not stored, they are computed from the tf when the
+                # postings are decoded (see InvertedIndexSearcher.decode_binary_postings)
+                binary_postings = [
+                    (doc_id, len(positions), positions)
+                    for doc_id, positions in zip(doc_ids, positions_lists)
+                ]
+
+                payload = encode_postings(
+                    binary_postings, impacts, self.impact_format, SKIP_INTERVAL, skip_offsets,
+                    positions_offsets
+                )
+                record = encode_record(term, payload)
+                final_block_file.write(record)
+
+                postings_offset = block_offset + len(record) - len(payload)
+                postings_length = len(payload)
+                block_offset += len(record)
+            else:
+                data = f"{term} ".encode("utf-8")
+                final_block_file.write(data)
+                block_offset += len(data)
+                postings_offset = block_offset
+
+                if rewrite:
+                    # "[<positions>]" or the offset of the positions in the positions file
+                    positions_column = positions_offsets if positions_offsets is not None else \
+                        [positions for _, _, positions in postings]
+
+                    # if func is none at this point, then we may assume that the
+                    # document frequency chosen is the no (n) one
+                    if func is not None:
+                        # we want tfidf, so we have to multiply tf with idf
+                        idf = func(n_postings)
+                        text_postings = [
+                            f"{doc_id}:{float(weight) * idf}:{positions}"
+                            for doc_id, weight, positions in zip(doc_ids, weights, positions_column)
+                        ]
+                    elif impacts is not None:
+                        # the bm25 impact replaces the tf
+                        text_postings = [
+                            f"{doc_id}:{impact}:{positions}"
+                            for doc_id, positions, impact in zip(doc_ids, positions_column, impacts)
+                        ]
+                    else:
+                        text_postings = [
+                            f"{doc_id}:{weight}:{positions}"
+                            for doc_id, weight, positions in zip(doc_ids, weights, positions_column)
+                        ]
+                    posting_lengths = map(len, text_postings)
+                    segments = [";".join(text_postings)]
+
+                # postings are ascii and separated by one byte, so the offset of the i-th
+                # posting is the length of the ones before it plus i
+                start_offsets = list(accumulate(posting_lengths, initial=0))
+                skip_offsets = [start_offsets[i] + i for i in range(0, n_postings, SKIP_INTERVAL)]
+
+                # the segments are streamed to the final block
+                for i, segment in enumerate(segments):
+                    data = segment.encode("utf-8") if i == 0 else b";" + segment.encode("utf-8")
+                    final_block_file.write(data)
+                    block_offset += len(data)
+
+                # the line break is not part of the postings
+                postings_length = block_offset - postings_offset
+                final_block_file.write(b"\n")
+                block_offset += 1
+
+            # <n postings: uint32> <n skips: uint32> <last doc id of each skip: uint32>
+            # <offset of each skip: uint32> <doc id before each skip: uint32>
+            skip_last_docs = array('I', (
+                doc_ids[min(i + SKIP_INTERVAL, n_postings) - 1]
+                for i in range(0, n_postings, SKIP_INTERVAL)
+            ))
+            skip_previous_docs = array('I', (
+                doc_ids[i - 1] if i > 0 else 0
+                for i in range(0, n_postings, SKIP_INTERVAL)
+            ))
+            skip_data = struct.pack("<II", n_postings, len(skip_offsets)) + skip_last_docs.tobytes() + \
+                array('I', skip_offsets).tobytes() + skip_previous_docs.tobytes()
+            skip_pointers_file.write(skip_data)
+
+            max_score = 0.0
+            term_block_max_offset = 0
+            if weight_method == "bm25":
+                block_starts = range(0, n_postings, BLOCK_MAX_SIZE)
+                block_last_docs = array('I', (
+                    doc_ids[min(i + BLOCK_MAX_SIZE, n_postings) - 1] for i in block_starts
+                ))
+                block_max_scores = array('d', np.maximum.reduceat(scores, block_starts).tobytes())
+
+                max_score = max(block_max_scores)
+
+                # <n blocks: uint32> <last doc id of each block: uint32> <max score of each block: double>
+                term_block_max_offset = block_max_offset
+                data = struct.pack("<I", len(block_last_docs)) + \
+                    block_last_docs.tobytes() + block_max_scores.tobytes()
+                block_max_file.write(data)
+                block_max_offset += len(data)
+
+            dictionary_entries.append((
+                term, final_block_counter, postings_offset, postings_length,
+                max_score, term_block_max_offset, skip_pointers_offset
+            ))
+            skip_pointers_offset += len(skip_data)
+
+            # normalization calcs (doc ids are unique in the postings of a term)
+            if doc_index is not None:
+                if kwargs["tfidf"]["smart"][2] == 'c':
+                    term_weights = np.fromiter(map(float, weights), dtype=np.float64, count=n_postings)
+                    doc_index[doc_ids_array] += term_weights * term_weights
+                elif kwargs["tfidf"]["smart"][2] == 'u':
+                    # in the end we want to know how many unique terms are in each doc
+                    doc_index[doc_ids_array] += 1
+
+            last_term = term
+            block_lines += 1
+            n_tokens += 1
+
+            # We are building blocks of files and an index file
+            # We will create a new block file when the number of lines in
+            # the current block file is greater than the token_threshold
+            if block_lines >= self.token_threshold:
+
+                print(
+                    (f"Block {final_block_counter} finished | " +
+                    f"first_term={first_term} and last_term={last_term}"),
+                    end="\r"
+                )
+
+                # We have to update the index file
+                # We will write the first and last term of the block and the block's filename
+                index_file.write(
+                    f"{first_term} {last_term} {folder}/final_block_{final_block_counter}.{extension}\n"
+                )
+
+                # Close the actual block file
+                final_block_file.close()
+                final_block_file = None
+
+                # Add the size of the block file to the index size
+                index_size += os.path.getsize(f"{folder}/final_block_{final_block_counter}.{extension}")
+
+                # The next term goes to a new block file
+                final_block_counter += 1
+                block_lines = 0
+
+        if final_block_file is not None:
+            # We have to update the index file
+            # We will write the first and last term of the block and the block's filename
+            index_file.write(
+                f"{first_term} {last_term} {folder}/final_block_{final_block_counter}.{extension}\n"
+            )
+            final_block_file.close()
+
+            # Add the size of the block file to the index size
+            index_size += os.path.getsize(f"{folder}/final_block_{final_block_counter}.{extension}")
+
+        index_file.close()
 
         # Add the size of the index file to the index size
         index_size += os.path.getsize(f"{folder}/index.txt")
 
-        print(f"Block {final_block_counter} finished")
+        TermDictionary.write(f"{folder}/{TermDictionary.filename}", dictionary_entries)
+        index_size += os.path.getsize(f"{folder}/{TermDictionary.filename}")
+
+        if block_max_file is not None:
+            block_max_file.close()
+            index_size += os.path.getsize(f"{folder}/{BLOCK_MAX_FILENAME}")
+
+        skip_pointers_file.close()
+        index_size += os.path.getsize(f"{folder}/{SKIP_POINTERS_FILENAME}")
 
-        # Add the size of the block file to the index size
-        index_size += os.path.getsize(f"{folder}/final_block_{final_block_counter}.txt")
+        if positions_file is not None:
+            positions_file.close()
+            index_size += os.path.getsize(f"{folder}/{POSITIONS_FILENAME}")
+
+        print(f"Block {final_block_counter} finished")
 
         # normalization calcs
-        if weight_method == "tfidf":
+        # the norm of every document is stored as an array of doubles, indexed by the doc id
+        # cosine (c): sqrt(sum(weight ** 2)) | pivoted unique (u): (1 - slope) * pivot + slope * n_unique
+        if doc_index is not None:
             if kwargs["tfidf"]["smart"][2] == 'c':
-                with open(f"{folder}/doc_norms.txt", "w") as norm_file:
-                    for doc_id, weight in doc_index.items():
-                        norm_file.write(
-                            f"{doc_id} {sqrt(weight)}\n"
-                        )
+                doc_norms = np.sqrt(doc_index)
             elif kwargs["tfidf"]["smart"][2] == 'u':
-                with open(f"{folder}/doc_unique_counts.txt", "w") as counts_file:
-                    for doc_id, n_unique in doc_index.items():
-                        counts_file.write(
-                            f"{doc_id} {n_unique}\n"
-                        )
-
-        print("Merge complete...")
+                # the pivot is the average number of unique terms in a document
+                has_terms = doc_index > 0
+                self.pivot = int(doc_index.sum()) / int(has_terms.sum())
+                doc_norms = np.where(
+                    has_terms, (1.0 - self.slope) * self.pivot + self.slope * doc_index, 0.0
+                )
 
-        print("Deleting temporary files...")
-        # We will delete the temporary files
-        for filename in self.filenames:
-            os.remove(filename)
+            with open(f"{folder}/{DOC_NORMS_FILENAME}", "wb") as norm_file:
+                doc_norms.astype(np.float64).tofile(norm_file)
 
         toc = time()
 
         self.index_size = index_size
         self.n_tokens = n_tokens
         self.merging_time = toc - tic
+        self.merging_throughput = blocks_size / (1<<20) / self.merging_time if self.merging_time else 0
+
+        print(
+            f"Merge complete... {blocks_size/(1<<20):.2f}mb of blocks merged in",
+            f"{self.merging_time:.2f}s ({self.merging_throughput:.2f} MB/s)"
+        )
 
+        print("Deleting temporary files...")
+        # We will delete the temporary files
+        for filename in self.filenames:
+            os.remove(filename)
 
     @classmethod
     def load_from_disk(cls, path_to_folder:str):
@@ -597,17 +1778,56 @@ class InvertedIndexSearcher(BaseIndex):
     Created to keep classes simple and focused on one task
     """
 
-    def __init__(self, posting_threshold, path_to_folder):
+    def __init__(self, posting_threshold, path_to_folder, posting_cache_mb=None):
         super().__init__(posting_threshold, **{'token_threshold': None})
         self.path_to_folder = path_to_folder
+
+        # decoded posting lists of the most recently searched tokens
+        self.posting_cache = PostingListCache(posting_cache_mb)
         self.index = self.read_index_file()
 
+        # indexes built before the term dictionary existed are searched block by block
+        self.term_dictionary = None
+        if os.path.exists(f"{path_to_folder}/{TermDictionary.filename}"):
+            self.term_dictionary = TermDictionary(f"{path_to_folder}/{TermDictionary.filename}")
+        # skip pointers of every posting list (memory mapped)
+        self.skip_pointers = None
+        if os.path.exists(f"{path_to_folder}/{SKIP_POINTERS_FILENAME}"):
+            with open(f"{path_to_folder}/{SKIP_POINTERS_FILENAME}", "rb") as f:
+                self.skip_pointers = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # block max scores of the bm25 posting lists (memory mapped)
+        self.block_max = None
+        if os.path.exists(f"{path_to_folder}/{BLOCK_MAX_FILENAME}") and \
+                os.path.getsize(f"{path_to_folder}/{BLOCK_MAX_FILENAME}") > 0:
+            with open(f"{path_to_folder}/{BLOCK_MAX_FILENAME}", "rb") as f:
+                self.block_max = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # separate positions (memory mapped), only read by read_positions
+        self.positions_data = None
+        if os.path.exists(f"{path_to_folder}/{POSITIONS_FILENAME}") and \
+                os.path.getsize(f"{path_to_folder}/{POSITIONS_FILENAME}") > 0:
+            with open(f"{path_to_folder}/{POSITIONS_FILENAME}", "rb") as f:
+                self.positions_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # open final block files | { block number : file }
+        self.block_files = {}
+
         # metadata
         self.n_documents = 0
         self.weight_method = None
         self.smart = None
         self.bm25_b = None
         self.bm25_k1 = None
+        self.pub_avg_length = None
+        self.doc_pmids = None
+        self.doc_lengths = None
+        # tfidf document norms, pivoted unique normalization parameters
+        self.doc_norms = None
+        self.pivot = None
+        self.slope = 0.3
+        # precomputed bm25 impacts (None, "double" or "uint8") and quantization scale
+        self.bm25_impacts = None
+        self.bm25_impact_scale = None
+        # { (k1, b) : length normalization of every publication }, least recently used first
+        self.bm25_length_norms = OrderedDict()
         self.read_index_metadata()
 
     def read_index_metadata(self):
@@ -618,6 +1838,7 @@ class InvertedIndexSearcher(BaseIndex):
         self.n_documents = os.getxattr(
             f"{self.path_to_folder}/index.txt", 'user.indexer_n_documents'
         ).decode('utf-8')
+        self.read_doc_pmids()
         self.weight_method = os.getxattr(
             f"{self.path_to_folder}/index.txt", 'user.indexer_weight'
         ).decode('utf-8')
@@ -626,11 +1847,53 @@ class InvertedIndexSearcher(BaseIndex):
             self.smart = os.getxattr(
                 f"{self.path_to_folder}/index.txt", 'user.indexer_smart'
             ).decode('utf-8')
+            self.read_doc_norms()
         elif self.weight_method == 'bm25':
-            pass
+            self.pub_avg_length = float(os.getxattr(
+                f"{self.path_to_folder}/index.txt", 'user.indexer_pub_avg_length'
+            ).decode('utf-8'))
+            self.read_doc_lengths()
+            try:
+                self.bm25_k1 = float(os.getxattr(
+                    f"{self.path_to_folder}/index.txt", 'user.indexer_bm25_k1'
+                ).decode('utf-8'))
+                self.bm25_b = float(os.getxattr(
+                    f"{self.path_to_folder}/index.txt", 'user.indexer_bm25_b'
+                ).decode('utf-8'))
+            except OSError:
+                # indexes built before the term max scores existed
+                self.bm25_k1 = None
+                self.bm25_b = None
+
+            try:
+                self.bm25_impacts = os.getxattr(
+                    f"{self.path_to_folder}/index.txt", 'user.indexer_bm25_impacts'
+                ).decode('utf-8') or None
+            except OSError:
+                self.bm25_impacts = None
+            if self.bm25_impacts == "uint8":
+                self.bm25_impact_scale = float(os.getxattr(
+                    f"{self.path_to_folder}/index.txt", 'user.indexer_bm25_impact_scale'
+                ).decode('utf-8'))
         else:
             raise NotImplementedError
 
+        try:
+            self.posting_format = os.getxattr(
+                f"{self.path_to_folder}/index.txt", 'user.indexer_posting_format'
+            ).decode('utf-8')
+        except OSError:
+            # indexes built before the binary format existed are always text
+            self.posting_format = "text"
+
+        try:
+            self.positions_storage = os.getxattr(
+                f"{self.path_to_folder}/index.txt", 'user.indexer_positions_storage'
+            ).decode('utf-8')
+        except OSError:
+            # indexes built before the positions file existed have them in the postings
+            self.positions_storage = "inline"
+
     def read_index_file(self):
         """
         This function reads the index.txt created by the merge function from InvertedIndex function
@@ -661,57 +1924,6 @@ class InvertedIndexSearcher(BaseIndex):
 
         return index
 
-    def read_norm_file(self):
-        """
-        This function only works when the normalization method is cosine
-        It reads the file that contains the sqrt(token_weigth**2 for every token in doc)
-        """
-        if self.weight_method != 'tfidf' or self.smart.split('.')[0][2] != 'c':
-            raise Exception(
-                'read_norm_file function can only be called when the normalization is based on cosine'
-            )
-
-        if not os.path.exists(f"{self.path_to_folder}/doc_norms.txt"):
-            raise FileNotFoundError
-
-        doc_norms = {}
-        with open(f"{self.path_to_folder}/doc_norms.txt") as norm_file:
-            line = norm_file.readline()
-            while line != "" and line is not None:
-                doc_id, weight = line.split(' ')
-
-                doc_norms[doc_id] = float(weight)
-
-                line = norm_file.readline()
-
-        return doc_norms
-
-    def read_unique_counts_file(self):
-        """
-        This function only works when the normalization method is pivoted unique
-        It reads the file that contains the number of unique tokens in each document
-        """
-        if self.weight_method != 'tfidf' or self.smart.split('.')[0][2] != 'u':
-            raise Exception(
-                'read_norm_file function can only be called when \
-                the normalization is based on pivoted unique'
-            )
-
-        if not os.path.exists(f"{self.path_to_folder}/doc_unique_counts.txt"):
-            raise FileNotFoundError
-
-        unique_counts = {}
-        with open(f"{self.path_to_folder}/doc_unique_counts.txt") as norm_file:
-            line = norm_file.readline()
-            while line != "" and line is not None:
-                doc_id, count = line.split(' ')
-
-                unique_counts[doc_id] = int(count.strip())
-
-                line = norm_file.readline()
-
-        return unique_counts
-
     def find_in_index(self, token):
         """
         Binary search implementation to find token's block file in index
@@ -742,45 +1954,6 @@ class InvertedIndexSearcher(BaseIndex):
         # If we reach here, then the element was not present
         return -1
 
-    def find_in_block_binary(self, block_path, token):
-        """
-        Binary search implementation to find token's postings list in the block file.
-        Returns 'None' if the line hasn't been found.
-        Returns the postings list if the token is in the block file.
-        """
-        block_lines = []
-        with open(block_path, 'r') as block:
-            block_lines = block.readlines()
-
-        low = 1
-        high = len(block_lines)
-        mid = 1
-
-        while low <= high:
-
-            mid = (high + low) // 2
-
-            # Retrieve the middle line of the block file | { <token> : <postings_list> }
-            line = linecache.getline(block_path,mid).strip().split(" ")
-            print(line)
-
-            # If token is greater than the last token on this index line,
-            # we ignore the left half of the index
-            if line[0] < token:
-                low = mid + 1
-
-            # If token is smaller than the first token on this index line,
-            # we ignore the right half of the index
-            elif line[0] > token:
-                high = mid - 1
-
-            # Token is between the first and last tokens on this index line
-            else:
-                return line[1]  # Return postings list
-
-        # If we reach here, then the element was not present
-        return None
-
     def find_in_block(self, block_path, token):
         """
         Iterates through all lines in the block and searches for the token
@@ -800,19 +1973,276 @@ class InvertedIndexSearcher(BaseIndex):
 
         return None
 
+    def find_in_compressed_block(self, block_path, token):
+        """
+        Iterates through all the records of a binary block and searches for the token
+        Returns the encoded postings (payload) of the token or None
+        """
+
+        token = token.encode('utf-8')
+        with open(block_path, 'rb') as block:
+            while True:
+                term_length = read_varint(block)
+                if term_length is None:
+                    return None
+
+                block_token = block.read(term_length)
+                payload_length = read_varint(block)
+
+                if block_token == token:
+                    return block.read(payload_length)
+
+                if block_token > token:
+                    return None
+
+                block.seek(payload_length, os.SEEK_CUR)
+
+    def decode_binary_postings(self, payload):
+        """
+        Decodes the payload of a binary block into the same dictionary that
+        is built from the text format {doc_id1: (weight1, positions1), ...}
+        The text format stores the weights, the binary one only stores the tf,
+        so the weights are computed here exactly like the indexer does
+        (except for the precomputed bm25 impacts, which are stored)
+        """
+
+        # separate positions: the positions are the offsets in the positions file
+        postings = decode_postings(payload, self.bm25_impacts, self.positions_storage == "separate")
+
+        if self.bm25_impacts == "uint8":
+            return {
+                doc_id: (impact / self.bm25_impact_scale, positions)
+                for doc_id, _, positions, impact in postings
+            }
+        if self.bm25_impacts == "double":
+            return {
+                doc_id: (impact, positions)
+                for doc_id, _, positions, impact in postings
+            }
+
+        if self.weight_method == 'tfidf':
+            idf = None
+            if self.smart[1] == 't':
+                idf = log10(int(self.n_documents)/len(postings))
+
+            results = {}
+            for doc_id, tf, positions in postings:
+                weight = 1 + log10(tf) if self.smart[0] == 'l' else float(tf)
+                results[doc_id] = (weight * idf if idf is not None else weight, positions)
+            return results
+
+        return {
+            doc_id: (float(tf), positions)
+            for doc_id, tf, positions in postings
+        }
+
+    def read_postings(self, block_number, offset, length):
+        """
+        Reads the postings of a term from a final block (one seek and one read)
+        """
+
+        if block_number not in self.block_files:
+            self.block_files[block_number] = open(self.index[block_number]['path'], 'rb')
+
+        block = self.block_files[block_number]
+        block.seek(offset)
+        return block.read(length)
+
+    def read_positions(self, offset):
+        """
+        Decodes the positions of a posting from the positions file,
+        offset is the value that replaces the positions in the postings (separate positions)
+        """
+        return decode_positions(self.positions_data, offset)[0]
+
+    def get_max_score(self, token, k1, b):
+        """
+        Returns the BM25 max score of a token stored in the term dictionary
+        Returns None if it is not available (the index was built with other k1 and b,
+        has no term dictionary or the token doesn't exist)
+        """
+
+        if self.term_dictionary is None or (k1, b) != (self.bm25_k1, self.bm25_b):
+            return None
+
+        entry = self.term_dictionary.find(token)
+        if entry is None:
+            return None
+
+        return entry[3]
+
+    def get_block_max_scores(self, token, k1, b):
+        """
+        Returns the last doc id and the BM25 max score of every block of
+        BLOCK_MAX_SIZE postings of the token, as two arrays
+        Returns None if they are not available (same cases as get_max_score)
+        """
+
+        if self.block_max is None or (k1, b) != (self.bm25_k1, self.bm25_b):
+            return None
+
+        entry = self.term_dictionary.find(token)
+        if entry is None:
+            return None
+
+        offset = entry[4]
+        n_blocks = struct.unpack_from("<I", self.block_max, offset)[0]
+        offset += 4
+
+        block_last_docs = array('I')
+        block_last_docs.frombytes(self.block_max[offset:offset + n_blocks * block_last_docs.itemsize])
+        offset += n_blocks * block_last_docs.itemsize
+
+        block_max_scores = array('d')
+        block_max_scores.frombytes(self.block_max[offset:offset + n_blocks * block_max_scores.itemsize])
+
+        return block_last_docs, block_max_scores
+
+    def open_cursor(self, token, weights=False):
+        """
+        Returns a PostingCursor over the doc ids of the token or None if it doesn't exist
+        Only the doc ids of the blocks that the cursor visits are decoded
+        With weights a ScoredPostingCursor is returned, that also decodes their weights
+        """
+
+        if self.skip_pointers is None or self.term_dictionary is None:
+            # indexes without skip pointers: a single block with every doc id
+            posting_list = self.search_token(token)
+            if not posting_list:
+                return None
+            doc_ids = sorted(posting_list)
+            if weights:
+                block = (doc_ids, [posting_list[doc_id][0] for doc_id in doc_ids])
+                return ScoredPostingCursor(len(doc_ids), [doc_ids[-1]], lambda _: block)
+            return PostingCursor(len(doc_ids), [doc_ids[-1]], lambda block: doc_ids)
+
+        entry = self.term_dictionary.find(token)
+        if entry is None:
+            return None
+
+        block_number, postings_offset, postings_length, _, _, offset = entry
+        n_postings, n_skips = struct.unpack_from("<II", self.skip_pointers, offset)
+        offset += 8
+
+        skip_arrays = []
+        for _ in range(3):
+            skip_array = array('I')
+            skip_array.frombytes(self.skip_pointers[offset:offset + n_skips * skip_array.itemsize])
+            offset += n_skips * skip_array.itemsize
+            skip_arrays.append(skip_array)
+        skip_last_docs, skip_offsets, skip_previous_docs = skip_arrays
+
+        postings = self.read_postings(block_number, postings_offset, postings_length)
+
+        def load_block(block):
+            count = min(SKIP_INTERVAL, n_postings - block * SKIP_INTERVAL)
+            if self.posting_format == "binary":
+                return decode_doc_ids(
+                    postings, skip_offsets[block], count, skip_previous_docs[block], self.bm25_impacts,
+                    self.positions_storage == "separate"
+                )
+
+            # text postings: <doc_id>:<weight>:<positions>;...
+            doc_ids = []
+            position = skip_offsets[block]
+            for _ in range(count):
+                end = postings.index(b":", position)
+                doc_ids.append(int(postings[position:end]))
+                position = postings.find(b";", end) + 1
+            return doc_ids
+
+        def load_weighted_block(block):
+            count = min(SKIP_INTERVAL, n_postings - block * SKIP_INTERVAL)
+            if self.posting_format == "binary":
+                doc_ids, block_weights = decode_doc_weights(
+                    postings, skip_offsets[block], count, skip_previous_docs[block], self.bm25_impacts,
+                    self.positions_storage == "separate"
+                )
+                if self.bm25_impacts == "uint8":
+                    block_weights = [impact / self.bm25_impact_scale for impact in block_weights]
+                elif self.bm25_impacts is None:
+                    block_weights = [float(tf) for tf in block_weights]
+                return doc_ids, block_weights
+
+            # text postings of the block: <doc_id>:<weight>:<positions>;...
+            end = skip_offsets[block + 1] if block + 1 < len(skip_offsets) else len(postings)
+            fields = POSTING_FIELDS.findall(postings[skip_offsets[block]:end].decode('utf-8'))
+            doc_ids = [int(doc_id) for doc_id, _ in fields]
+
+            # quantized bm25 impacts are stored as integers
+            if self.bm25_impacts == "uint8":
+                return doc_ids, [int(impact) / self.bm25_impact_scale for _, impact in fields]
+            return doc_ids, [float(weight) for _, weight in fields]
+
+        if weights:
+            return ScoredPostingCursor(n_postings, skip_last_docs, load_weighted_block)
+        return PostingCursor(n_postings, skip_last_docs, load_block)
+
     def search_token(self, token):
         """
         Verifies if a token exists in the index
         If it exists the function returns its posting list
         If it doesn't exist the function returns None
-        This function uses Binary Search to find the token in the index
-        and then searches in the block file until it finds the token
+        Recently searched tokens are served by the posting list cache
+        """
+
+        cached, compact_list = self.posting_cache.get(token)
+        if cached:
+            return PostingListCache.expand(compact_list)
+
+        posting_list = self.read_token(token)
+        self.posting_cache.put(token, PostingListCache.compact(posting_list))
+        return posting_list
+
+    def search_token_arrays(self, token):
+        """
+        Same as search_token, but the posting list is returned as two numpy arrays
+        (doc ids, weights) sorted by doc id, without the positions
+        Used by the vectorized rankers, the arrays are those of the posting list cache
+        """
+
+        cached, compact_list = self.posting_cache.get(token)
+        if not cached:
+            compact_list = PostingListCache.compact(self.read_token(token))
+            self.posting_cache.put(token, compact_list)
+
+        if compact_list is None:
+            return None
+        return compact_list[0], compact_list[1]
+
+    def read_token(self, token):
         """
+        Reads and decodes the posting list of a token from disk
+        This function uses Binary Search to find the token in the term dictionary
+        and then reads its postings directly from the block file.
+        Indexes without term dictionary use Binary Search to find the token's block
+        in the index and then search in the block file until they find the token
+        """
+
+        if self.term_dictionary is not None:
+            entry = self.term_dictionary.find(token)
+            if entry is None:
+                return None
+
+            postings = self.read_postings(*entry[:3])
+            if self.posting_format == "binary":
+                return self.decode_binary_postings(postings)
+
+            return self.decode_text_postings(postings.decode('utf-8'))
 
         index_position = self.find_in_index(token)
         if index_position == -1:
             return None
 
+        if self.posting_format == "binary":
+            payload = self.find_in_compressed_block(
+                block_path = self.index[index_position]['path'],
+                token = token
+            )
+            if payload is None:
+                return None
+            return self.decode_binary_postings(payload)
+
         posting_list = self.find_in_block(
             block_path = self.index[index_position]['path'],
             token = token
@@ -820,15 +2250,33 @@ class InvertedIndexSearcher(BaseIndex):
         if not posting_list:
             return None
 
+        return self.decode_text_postings(posting_list)
+
+    def decode_text_postings(self, posting_list):
+        """
+        Converts the postings of a text block into a dictionary
+        """
+
         # posting list is a string with the format:
-        # <doc1>:<no_normalized_weight1>,<doc2>:<no_normalized_weight2>,...
+        # <doc1>:<no_normalized_weight1>:[<positions1>];<doc2>:<no_normalized_weight2>:[<positions2>];...
         # we want it to be a dictionary with
-        # {'doc1': no_normalized_weight1, ...}
-
-        return {
-            doc_info.split(":")[0]: (float(doc_info.split(":")[1]),doc_info.split(":")[2])
-            for doc_info in posting_list.split(";")
-        }
+        # {doc1: (no_normalized_weight1, '[<positions1>]'), ...}
+        # with separate positions '[<positions>]' is the offset of the positions in the
+        # positions file, they are only decoded when they are needed (see read_positions)
+
+        # quantized bm25 impacts are stored as integers
+        if self.bm25_impacts == "uint8":
+            results = {}
+            for doc_info in posting_list.split(";"):
+                doc_id, impact, positions = doc_info.split(":")
+                results[int(doc_id)] = (int(impact) / self.bm25_impact_scale, positions)
+            return results
+
+        results = {}
+        for doc_info in posting_list.split(";"):
+            doc_id, weight, positions = doc_info.split(":")
+            results[int(doc_id)] = (float(weight), positions)
+        return results
 
     def get_tokenizer_kwargs(self):
         """
@@ -858,31 +2306,69 @@ class InvertedIndexSearcher(BaseIndex):
         }
 
 
-    def get_pubs_length(self):
+    def read_doc_lengths(self):
         """
-        This method returns the *pubs_length.txt* file which contains the pub_id and the
-        length of the publication. Additionally, it will get the metadata attributes
-        containing the total number of documents and the average length of the publications. 
-        Needed for BM25 ranking.
+        Loads the length of every publication (array indexed by doc id),
+        which is needed for BM25 ranking
         """
 
-        pubs_length = {}
+        self.doc_lengths = array('I')
+        with open(f"{self.path_to_folder}/{DOC_LENGTHS_FILENAME}", "rb") as f:
+            self.doc_lengths.frombytes(f.read())
 
-        pub_avg_length = os.getxattr(
-            f"{self.path_to_folder}/index.txt", 'user.indexer_pub_avg_length'
-        ).decode('utf-8')
-        n_documents = os.getxattr(
-            f"{self.path_to_folder}/index.txt", 'user.indexer_n_documents'
-        ).decode('utf-8')
+    def read_doc_pmids(self):
+        """
+        Loads the doc id -> pmid mapping, doc ids are only translated
+        to pmids when the results are presented
+        """
 
-        # Retrieve key-value pairs of pub_lenght | "<pmid> <pub_length>"
-        with open(f"{self.path_to_folder}/pubs_length.txt","rb") as f:
-            for line in f:
-                pair = line.decode('utf-8').strip().split(" ")
-                pubs_length[pair[0]] = pair[1]
+        with open(f"{self.path_to_folder}/{DOC_PMIDS_FILENAME}") as f:
+            self.doc_pmids = [pmid.rstrip("\n") for pmid in f]
 
-        return {
-            'pub_avg_length': pub_avg_length,
-            'n_documents': n_documents,
-            'pubs_length': pubs_length
-        }
+    def get_pmid(self, doc_id):
+        return self.doc_pmids[doc_id]
+
+    def read_doc_norms(self):
+        """
+        Loads the tfidf document norms (cosine or pivoted unique) once.
+        doc_norms.bin is memory mapped as an array of doubles indexed by doc id
+        and the pivot used by the pivoted unique normalization is read from the metadata
+        """
+
+        normalization = self.smart.split('.')[0][2]
+        if normalization not in ('c', 'u'):
+            return
+
+        with open(f"{self.path_to_folder}/{DOC_NORMS_FILENAME}", "rb") as norm_file:
+            self.doc_norms = memoryview(
+                mmap.mmap(norm_file.fileno(), 0, access=mmap.ACCESS_READ)
+            ).cast('d')
+
+        if normalization == 'u':
+            self.pivot = float(os.getxattr(
+                f"{self.path_to_folder}/index.txt", 'user.indexer_pivot'
+            ).decode('utf-8'))
+            self.slope = float(os.getxattr(
+                f"{self.path_to_folder}/index.txt", 'user.indexer_slope'
+            ).decode('utf-8'))
+
+    def get_bm25_length_norms(self, k1, b):
+        """
+        Returns the BM25 length normalization of every publication,
+        k1 * ((1 - b) + b * (pub_length / avg_pub_length)), indexed like doc_lengths.
+        Only the BM25_LENGTH_NORMS_CACHE_SIZE most recently used (k1, b) are kept
+        """
+
+        if (k1, b) in self.bm25_length_norms:
+            self.bm25_length_norms.move_to_end((k1, b))
+            return self.bm25_length_norms[(k1, b)]
+
+        avg_pub_length = self.pub_avg_length
+        length_norms = array('d', (
+            k1 * ( (1 - b) + b * (pub_length/avg_pub_length) )
+            for pub_length in self.doc_lengths
+        ))
+        self.bm25_length_norms[(k1, b)] = length_norms
+        while len(self.bm25_length_norms) > BM25_LENGTH_NORMS_CACHE_SIZE:
+            self.bm25_length_norms.popitem(last=False)
+        return length_norms
@@ -165,6 +165,29 @@ def shared_tokenizer(parser, default_value=None):
                                     default=None,
                                     help='Type of stemmer to be used. The absence means that will not be used (default=None).')
 
+    parser.add_argument('--tk.stem_cache_size',
+                                    type=int,
+                                    action=RecordArgument,
+                                    default=None,
+                                    help='Maximum number of stems memoized by the tokenizer (default=100000).')
+
+def shared_ranking(parser):
+    # mutual exclusive searching modes
+    modes_parser = parser.add_subparsers(dest='ranking_mode', required=True)
+
+    bm25_mode_parser = modes_parser.add_parser('ranking.bm25', help='Uses the BM25 as the searching method')
+    bm25_mode_parser.add_argument("--ranking.bm25.class", type=str, default="BM25Ranking")
+    bm25_mode_parser.add_argument("--ranking.bm25.k1", type=float, default=None,
+                                  help='The k1 of the BM25. The absence means 1.2, or the k1 the index was built with when --ranking.bm25.pruning is wand or bmw (default=None).')
+    bm25_mode_parser.add_argument("--ranking.bm25.b", type=float, default=None,
+                                  help='The b of the BM25. The absence means 0.6, or the b the index was built with when --ranking.bm25.pruning is wand or bmw (default=None).')
+    bm25_mode_parser.add_argument("--ranking.bm25.pruning", type=str, choices=["bmw", "wand", "none"], default="none",
+                                  help='Dynamic pruning of the top-k search, bmw (Block-Max WAND), wand or none (exhaustive scoring). The pruning needs the max scores of the index, so the k1 and b must be the ones the index was built with (--indexer.bm25.k1 and --indexer.bm25.b), which is the default with pruning. (default=none).')
+
+    tfidf_mode_parser = modes_parser.add_parser('ranking.tfidf', help='Uses the TFIDF as the searching method')
+    tfidf_mode_parser.add_argument("--ranking.tfidf.class", type=str, default="TFIDFRanking")
+    tfidf_mode_parser.add_argument("--ranking.tfidf.smart", type=str, default="lnc.ltc")
+
 def grouping_args(args):
     """
     Auxiliar function to group the arguments group
@@ -178,7 +201,7 @@ def grouping_args(args):
     Params class.
     
     For instance:
-        indexer.posting_threshold and indexer.memory_threshold, will be 
+        indexer.posting_threshold and indexer.memory_budget_mb, will be 
         assigned to the same group "indexer", which can be then accessed
         through args.indexer
         
@@ -215,6 +238,7 @@ if __name__ == "__main__":
     # operation modes
     # - indexer
     # - searcher
+    # - server
     mode_subparsers = parser.add_subparsers(dest='mode', 
                                             required=True)
     
@@ -226,7 +250,7 @@ if __name__ == "__main__":
     
     indexer_parser.add_argument('path_to_collection', 
                                 type=str, 
-                                help='Name of the folder or file that holds the document collection to be indexed.')
+                                help='Name of the folder, file or glob pattern that holds the document collection to be indexed (the files are read in sorted order).')
     
     indexer_parser.add_argument('index_output_folder', 
                                 type=str, 
@@ -243,16 +267,37 @@ if __name__ == "__main__":
                                     default=None,
                                     help='Maximum number of postings that each index should hold.')
     
-    indexer_settings_parser.add_argument('--indexer.memory_threshold', 
+    indexer_settings_parser.add_argument('--indexer.memory_budget_mb', 
                                     type=int, 
                                     default=None,
-                                    help='Maximum limit of RAM that the program (index) should consume in %.')
+                                    help='Estimated size (MB) of the in-memory index (shared by the --indexer.workers) before it is written to a block. (default=512).')
 
     indexer_settings_parser.add_argument('--indexer.token_threshold', 
                                 type=int, 
                                 default=None,
                                 help='Maximum number of tokens that each index should hold.')
 
+    indexer_settings_parser.add_argument('--indexer.workers',
+                                type=int,
+                                default=None,
+                                help='Number of worker processes that tokenize and invert the collection in parallel (default=1).')
+
+    indexer_settings_parser.add_argument('--indexer.pipeline',
+                                action="store_true",
+                                help='The collection is read, tokenized (by --indexer.workers processes) and inverted by pipeline stages connected with bounded queues.')
+
+    indexer_settings_parser.add_argument('--indexer.posting_format',
+                                type=str,
+                                choices=["text", "binary"],
+                                default="text",
+                                help='Format of the final index postings, text or binary (delta + varint compressed). (default=text).')
+
+    indexer_settings_parser.add_argument('--indexer.positions_storage',
+                                type=str,
+                                choices=["inline", "separate"],
+                                default="inline",
+                                help='Where the term positions are stored, inline in the postings or in a separate file that is only read for the proximity boost and phrase queries (smaller postings, but a bigger index). (default=inline).')
+
     indexer_settings_parser.add_argument('--indexer.bm25.cache_in_disk', 
                                     action="store_true",
                                     help='The index will cache all intermediate values in order to speed up the BM25 computations.')
@@ -265,6 +310,14 @@ if __name__ == "__main__":
                                     type=float, default=0.7,
                                     help='The b value to be used if --indexer.bm25.cache_in_disk is enabled.')
     
+    indexer_settings_parser.add_argument('--indexer.bm25.impacts',
+                                    action="store_true",
+                                    help='The final BM25 impact of every posting, computed with --indexer.bm25.k1 and --indexer.bm25.b, is stored in the index instead of the tf.')
+
+    indexer_settings_parser.add_argument('--indexer.bm25.quantize',
+                                    action="store_true",
+                                    help='The BM25 impacts (--indexer.bm25.impacts) are quantized to 8 bits.')
+
     indexer_settings_parser.add_argument('--indexer.tfidf.cache_in_disk', 
                                     action="store_true",
                                     help='The index will cache all intermediate values in order to speed up the TFIDF computations.')
@@ -279,6 +332,17 @@ if __name__ == "__main__":
     
     # corpus reader
     shared_reader(indexer_doc_parser, "PubMedReader")
+
+    indexer_doc_parser.add_argument('--reader.chunk_size',
+                                type=int,
+                                default=None,
+                                help='Number of bytes decompressed from the collection at a time. (default=1048576).')
+
+    indexer_doc_parser.add_argument('--reader.json_backend',
+                                type=str,
+                                choices=["auto", "json", "orjson"],
+                                default="auto",
+                                help='JSON library used to decode the publications, auto uses orjson when it is installed. (default=auto).')
     
     # tokenizer
     shared_tokenizer(indexer_doc_parser)
@@ -320,6 +384,46 @@ if __name__ == "__main__":
                                 help='Multiplicative boost factor (for minimum window size)',
                                 required=False)
 
+    searcher_parser.add_argument('--boolean',
+                                action="store_true",
+                                help='Queries are boolean expressions with AND, OR, NOT and parentheses, only the matching documents are ranked (NOT only excludes documents from the ones with a term that is not negated, so a query with only negated terms matches nothing)',
+                                required=False)
+
+    searcher_parser.add_argument('--phrases',
+                                action="store_true",
+                                help='Queries can have "quoted phrases" and NEAR/k operators, only the documents that match them are ranked',
+                                required=False)
+
+    searcher_parser.add_argument('--posting_cache_mb',
+                                type=float,
+                                default=128,
+                                help='Memory budget (MB) of the LRU cache of posting lists (kept as compact arrays), 0 disables it (default=128).',
+                                required=False)
+
+    searcher_parser.add_argument('--workers',
+                                type=int,
+                                default=None,
+                                help='Number of worker processes that search the questions in parallel, each one loads the index once (default=1).',
+                                required=False)
+
+    searcher_parser.add_argument('--result_cache_size',
+                                type=int,
+                                default=0,
+                                help='Maximum number of query results kept in the LRU result cache, 0 disables it (default=0).',
+                                required=False)
+
+    searcher_parser.add_argument('--result_cache_ttl',
+                                type=float,
+                                default=None,
+                                help='Seconds after which a cached query result expires. The absence means that they never expire (default=None).',
+                                required=False)
+
+    searcher_parser.add_argument('--result_cache_path',
+                                type=str,
+                                default=None,
+                                help='File where the result cache is saved at the end of the search and loaded from in the next one (default=None).',
+                                required=False)
+
     # Searcher also specifies a reader
     # question reader
     shared_reader(searcher_parser, "QuestionsReader")
@@ -329,16 +433,66 @@ if __name__ == "__main__":
     shared_tokenizer(searcher_parser)
 
     # mutual exclusive searching modes
-    searcher_modes_parser = searcher_parser.add_subparsers(dest='ranking_mode', required=True)
-    
-    bm25_mode_parser = searcher_modes_parser.add_parser('ranking.bm25', help='Uses the BM25 as the searching method')
-    bm25_mode_parser.add_argument("--ranking.bm25.class", type=str, default="BM25Ranking")
-    bm25_mode_parser.add_argument("--ranking.bm25.k1", type=float, default=1.2)
-    bm25_mode_parser.add_argument("--ranking.bm25.b", type=float, default=0.6)
+    shared_ranking(searcher_parser)
 
-    tfidf_mode_parser = searcher_modes_parser.add_parser('ranking.tfidf', help='Uses the TFIDF as the searching method')
-    tfidf_mode_parser.add_argument("--ranking.tfidf.class", type=str, default="TFIDFRanking")
-    tfidf_mode_parser.add_argument("--ranking.tfidf.smart", type=str, default="lnc.ltc")
+    ############################
+    ##  Server CLI interface  ##
+    ############################
+    server_parser = mode_subparsers.add_parser('server', help='Server help')
+
+    server_parser.add_argument('index_folder',
+                                type=str,
+                                help='Folder where all the index related files will be loaded.')
+
+    server_parser.add_argument('--host',
+                                type=str,
+                                default="127.0.0.1",
+                                help='Address where the server listens (default=127.0.0.1).')
+
+    server_parser.add_argument('--port',
+                                type=int,
+                                default=8080,
+                                help='Port where the server listens (default=8080).')
+
+    server_parser.add_argument('--unix_socket',
+                                type=str,
+                                default=None,
+                                help='Path of a unix socket where the server listens instead of --host and --port.')
+
+    server_parser.add_argument('--top_k',
+                                type=int,
+                                default=10,
+                                help='Number maximum of documents returned when the request does not specify it (default=10).')
+
+    server_parser.add_argument('--max_concurrency',
+                                type=int,
+                                default=8,
+                                help='Maximum number of searches accepted at the same time, the others are rejected with 503 (default=8).')
+
+    server_parser.add_argument('--posting_cache_mb',
+                                type=float,
+                                default=128,
+                                help='Memory budget (MB) of the LRU cache of posting lists (kept as compact arrays), 0 disables it (default=128).')
+
+    server_parser.add_argument('--result_cache_size',
+                                type=int,
+                                default=0,
+                                help='Maximum number of query results kept in the LRU result cache, 0 disables it (default=0).')
+
+    server_parser.add_argument('--result_cache_ttl',
+                                type=float,
+                                default=None,
+                                help='Seconds after which a cached query result expires. The absence means that they never expire (default=None).')
+
+    server_parser.add_argument('--result_cache_path',
+                                type=str,
+                                default=None,
+                                help='File where the result cache is saved when the server stops and loaded from when it starts (default=None).')
+
+    shared_tokenizer(server_parser)
+
+    # default ranking, the requests can choose other parameters
+    shared_ranking(server_parser)
     # CLI parsing
     #args = parser.parse_args()
     args = grouping_args(parser.parse_args())
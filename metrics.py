@@ -32,6 +32,10 @@ class MetricsCalcultor:
             obtained_docs: list of documents returned by the query
             relevant_docs: list of relevant documents for the query
         """
+        # careful with division by zero errors (queries without results)
+        if not obtained_docs:
+            return 0
+
         return len(set(obtained_docs).intersection(set(relevant_docs))) / len(obtained_docs)
 
     @staticmethod
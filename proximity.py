@@ -0,0 +1,130 @@
+"""
+Authors:
+Gonçalo Leal - 98008
+Ricardo Rodriguez - 98388
+
+Proximity functions over the positions of the query terms in a document
+(minimum window, phrase and NEAR matching).
+
+The minimum window (minimum cover) is the smallest span of the document that
+contains at least one position of every term. It is found with a sorted merge of
+the (sorted) position lists: a heap holds the current position of each list, the
+window goes from the smallest to the largest of them and the list with the
+smallest position is always the one that advances.
+This takes O(total positions * log terms) instead of trying every combination.
+"""
+
+import heapq
+from bisect import bisect_left
+
+
+def min_cover(position_lists):
+    """
+    Finds the minimum window that covers one position of every list
+    position_lists: list of sorted integer lists, example [[1, 8], [4, 5], [6, 7]]
+    Returns (start, end, positions) where positions[i] is the position of the
+    i-th list inside the window, or None if any of the lists is empty
+    """
+
+    if not position_lists or any(len(positions) == 0 for positions in position_lists):
+        return None
+
+    # heap of (position, list index, index inside the list)
+    heap = [(positions[0], i, 0) for i, positions in enumerate(position_lists)]
+    heapq.heapify(heap)
+    window_end = max(positions[0] for positions in position_lists)
+
+    best = None
+    while True:
+        window_start, list_index, position_index = heap[0]
+
+        if best is None or window_end - window_start < best[1] - best[0]:
+            best = (window_start, window_end)
+
+        # the smallest position can't be part of a smaller window anymore
+        position_index += 1
+        if position_index == len(position_lists[list_index]):
+            break
+
+        position = position_lists[list_index][position_index]
+        heapq.heapreplace(heap, (position, list_index, position_index))
+        if position > window_end:
+            window_end = position
+
+    # every list has (at least) one position inside the best window
+    start, end = best
+    positions = [
+        positions[bisect_left(positions, start)] for positions in position_lists
+    ]
+
+    return start, end, positions
+
+
+def min_window_size(position_lists):
+    """
+    Size (number of positions) of the minimum window that covers every list
+    Returns None if any of the lists is empty
+    """
+
+    cover = min_cover(position_lists)
+    if cover is None:
+        return None
+
+    start, end, _ = cover
+    return end - start + 1
+
+
+def intersect_sorted(first, second):
+    """
+    Intersection of two sorted integer lists (two pointer merge)
+    """
+
+    result = []
+    i = j = 0
+    while i < len(first) and j < len(second):
+        if first[i] < second[j]:
+            i += 1
+        elif first[i] > second[j]:
+            j += 1
+        else:
+            result.append(first[i])
+            i += 1
+            j += 1
+    return result
+
+
+def phrase_starts(position_lists):
+    """
+    Positions where a phrase starts, position_lists[i] holds the (sorted)
+    positions of the i-th term of the phrase in the document, so the phrase
+    starts at p if p + i is in position_lists[i] for every i
+    """
+
+    if not position_lists:
+        return []
+
+    starts = list(position_lists[0])
+    for offset, positions in enumerate(position_lists[1:], 1):
+        starts = intersect_sorted(starts, [position - offset for position in positions])
+        if not starts:
+            break
+    return starts
+
+
+def is_near(starts_a, length_a, starts_b, length_b, distance):
+    """
+    Checks if an occurrence of a (phrases of length_a terms starting at starts_a)
+    is at most distance positions away from an occurrence of b, in any order
+    (distance = number of positions between the end of one and the start of the other,
+    adjacent occurrences have distance 1)
+    """
+
+    for start_a in starts_a:
+        # first occurrence of b that starts after a
+        i = bisect_left(starts_b, start_a)
+        if i < len(starts_b) and starts_b[i] - (start_a + length_a - 1) <= distance:
+            return True
+        # last occurrence of b that starts before a
+        if i > 0 and start_a - (starts_b[i - 1] + length_b - 1) <= distance:
+            return True
+    return False
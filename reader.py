@@ -5,11 +5,21 @@ Ricardo Rodriguez - 98388
 """
 
 import os
+import glob
 import gzip
 import json
-from time import time
 from utils import dynamically_init_class
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# decompressed bytes read from a collection file at a time
+CHUNK_SIZE = 1 << 20
+# files read when the collection is a directory
+COLLECTION_EXTENSIONS = (".jsonl.gz", ".json.gz", ".jsonl", ".json")
+
 
 def dynamically_init_reader(**kwargs):
     return dynamically_init_class(__name__, **kwargs)
@@ -34,33 +44,159 @@ class Reader:
         
     
 class PubMedReader(Reader):
-    
+    """
+    Reads the publications of a collection of jsonl files (gzip compressed or not).
+    The collection can be a file, a directory (every jsonl file in it) or a glob
+    pattern, the files are read in sorted order as a single corpus.
+
+    The files are decompressed in chunks of chunk_size bytes and split in lines by
+    the reader, which avoids the text mode readline of gzip. orjson is used to
+    decode the lines when it is installed (json_backend="auto")
+    """
+
     def __init__(self, 
                  path_to_collection:str,
+                 chunk_size=None,
+                 json_backend=None,
+                 batch_size=None,
                  **kwargs):
         super().__init__(path_to_collection, **kwargs)
-        print("init PubMedReader|", f"{self.path_to_collection=}")
+        self.chunk_size = chunk_size if chunk_size else CHUNK_SIZE
+        # number of publications decoded at a time when the reader is iterated
+        self.batch_size = batch_size if batch_size else 1024
+
+        self.json_backend = json_backend if json_backend else "auto"
+        if self.json_backend == "orjson" and orjson is None:
+            raise ImportError("json_backend orjson was chosen but orjson is not installed")
+        if self.json_backend != "json" and orjson is not None:
+            self.json_backend = "orjson"
+            self.loads = orjson.loads
+        else:
+            self.json_backend = "json"
+            self.loads = json.loads
+
+        self.files = self.list_files(self.path_to_collection)
+        print("init PubMedReader|", f"{self.path_to_collection=}, n_files={len(self.files)}, "
+              f"{self.chunk_size=}, {self.json_backend=}")
         if kwargs:
             print(f"{self.__class__.__name__} also caught the following additional arguments {kwargs}")
 
         self.extract_file()
 
+    @staticmethod
+    def list_files(path_to_collection):
+        """
+        Returns the sorted list of files of the collection
+        """
+        if os.path.isdir(path_to_collection):
+            files = [os.path.join(path_to_collection, filename)
+                     for filename in os.listdir(path_to_collection)
+                     if filename.endswith(COLLECTION_EXTENSIONS)]
+        elif os.path.isfile(path_to_collection):
+            return [path_to_collection]
+        else:
+            files = glob.glob(path_to_collection)
+
+        if not files:
+            raise FileNotFoundError(f"No collection files found in {path_to_collection}")
+        return sorted(files)
+
+    def read_pubs(self, batch_size=None):
+        """
+        Reads the next batch_size publications (the rest of the collection if
+        batch_size is None). Only the pmid, title and abstract are kept
+        Returns a list of (pmid, title + " " + abstract), empty at the end of the collection
+        """
+
+        loads = self.loads
+        pubs = []
+        while batch_size is None or len(pubs) < batch_size:
+            if self.line_index == len(self.lines) and not self.read_chunk():
+                break   # end of the collection
+
+            end = len(self.lines)
+            if batch_size is not None:
+                end = min(end, self.line_index + batch_size - len(pubs))
+
+            for line in self.lines[self.line_index:end]:
+                if not line:    # empty line (or new line at the end of a file)
+                    continue
+                pub_json = loads(line)
+                pubs.append((pub_json['pmid'], pub_json["title"] + " " + pub_json["abstract"]))
+            self.line_index = end
+
+        return pubs
+
+    def __iter__(self):
+        while 1:
+            pubs = self.read_pubs(self.batch_size)
+            if not pubs:
+                return
+            yield from pubs
+
     def read_next_pub(self):
 
-        line = self.file.readline()
-        if not line:
+        pubs = self.read_pubs(1)
+        if not pubs:
             return None, None # EOF (end of file)
 
-        pub_json = json.loads(line)
-        pmid = pub_json['pmid']
+        return pubs[0]
+
+    def read_chunk(self):
+        """
+        Decompresses the next chunk of the collection and splits it in lines, the
+        last line of a chunk may be incomplete so it is kept for the next one.
+        At the end of a file the next one is opened
+        Returns False at the end of the collection
+        """
+
+        while self.file is not None:
+            chunk = self.file.read(self.chunk_size)
+            if chunk:
+                data = self.remainder + chunk
+                end = data.rfind(b"\n") + 1
+                self.remainder = data[end:]
+                data = data[:end]
+            else:
+                # end of the file, its last line may not end with a new line
+                data = self.remainder
+                self.remainder = b""
+                self.close_file()
+                self.open_next_file()
+
+            if data:
+                # the chunk is decoded once, instead of every line by the json decoder
+                self.lines = data.decode("utf-8").split("\n")
+                self.line_index = 0
+                return True
+
+        return False
+
+    def open_next_file(self):
+        if self.file_index == len(self.files):
+            self.file = None
+            return
 
-        return pmid, pub_json["title"] + " " + pub_json["abstract"]
+        path = self.files[self.file_index]
+        self.file_index += 1
+        if path.endswith(".gz"):
+            self.file = gzip.open(path, mode="rb")
+        else:
+            self.file = open(path, mode="rb")
 
     def extract_file(self):
-        self.file = gzip.open(self.path_to_collection, mode="rt")
+        self.file = None
+        self.file_index = 0
+        # lines of the current chunk and the next one to be decoded
+        self.lines = []
+        self.line_index = 0
+        # incomplete line at the end of the previous chunk
+        self.remainder = b""
+        self.open_next_file()
 
     def close_file(self):
-        self.file.close()
+        if self.file is not None:
+            self.file.close()
 
 class QuestionsReader(Reader):
     """
@@ -3,16 +3,22 @@ Authors:
 Gonçalo Leal - 98008
 Ricardo Rodriguez - 98388
 """
-import itertools
 from metrics import MetricsCalcultor as mc
-from heapq import nlargest
+from heapq import nlargest, heappush, heapreplace
+from bisect import bisect_left
 from math import log10, sqrt, floor
 from utils import dynamically_init_class
+from proximity import min_cover, min_window_size, phrase_starts, is_near
+from boolean_query import BooleanQuery
 import os
+import re
 import statistics
 import time
-import itertools
+import json
+import multiprocessing
+from collections import OrderedDict
 from json import loads
+import numpy as np
 
 def dynamically_init_searcher(**kwargs):
     """Dynamically initializes a Tokenizer object from this
@@ -33,18 +39,319 @@ def dynamically_init_searcher(**kwargs):
     """
     return dynamically_init_class(__name__, **kwargs)
 
+# query syntax: "quoted phrases", NEAR/k operators and plain words
+QUERY_ITEMS = re.compile(r'"([^"]*)"|\bNEAR/(\d+)\b|([^\s"]+)')
+
+# BM25 parameters of the rankers that don't set them (the pruned rankers use the
+# ones the index was built with, when it stores them)
+DEFAULT_BM25_K1 = 1.2
+DEFAULT_BM25_B = 0.6
+
+# state of a parallel batch search worker process (see BaseSearcher.parallel_search)
+search_worker_state = {}
+
+def init_search_worker(ranker, index_class, index_folder, posting_cache_mb, tokenizer, top_k, boost):
+    """
+    Loads the index once in the worker process
+    """
+    # the result cache is only used (and updated) by the main process
+    ranker.result_cache = None
+    search_worker_state.update(
+        ranker=ranker,
+        index=index_class.load_from_disk(index_folder, posting_cache_mb=posting_cache_mb),
+        tokenizer=tokenizer,
+        top_k=top_k,
+        boost=boost
+    )
+
+def search_worker(query):
+    """
+    Answers a query in a worker process
+    Returns (worker pid, [(pmid, weight)] results, latency, posting cache statistics)
+    """
+    state = search_worker_state
+    results, latency = state['ranker'].answer_query(
+        state['index'], state['tokenizer'], query, state['top_k'], state['boost']
+    )
+    return os.getpid(), results, latency, state['index'].posting_cache.stats()
+
+class QueryResultCache:
+    """
+    LRU cache of query results, bounded by the number of entries and, optionally,
+    by their age (ttl in seconds). The keys are built by BaseSearcher.result_cache_key
+    (bag of query tokens, query constraints and ranking parameters), so queries that
+    only differ in stopwords, word order or inflections share the same results.
+    The cache can be saved to a json file and loaded in the next run, the entries
+    are discarded if the index was rebuilt in the meantime
+    """
+
+    def __init__(self, max_entries, ttl=None, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+
+        # { key : (time it was stored, [(pmid, score)]) }, from least to most recently used
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """
+        Returns (True, results) if the key is cached and (False, None) otherwise
+        """
+        if key in self.entries:
+            stored, results = self.entries[key]
+            if self.ttl is None or time.time() - stored <= self.ttl:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return True, results
+
+            del self.entries[key]
+            self.expirations += 1
+
+        self.misses += 1
+        return False, None
+
+    def put(self, key, results):
+        if not self.max_entries:
+            return
+
+        self.entries[key] = (time.time(), results)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    @staticmethod
+    def index_version(index):
+        """
+        Identifies the index (folder and build time), cached results of other indexes are discarded
+        """
+        return [
+            os.path.abspath(index.path_to_folder),
+            os.path.getmtime(f"{index.path_to_folder}/index.txt")
+        ]
+
+    def load(self, index):
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        with open(self.path) as cache_file:
+            data = json.load(cache_file)
+
+        if data["index"] != self.index_version(index):
+            return
+
+        for key, stored, results in data["entries"]:
+            self.entries[key] = (stored, [tuple(result) for result in results])
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self, index):
+        if not self.path:
+            return
+
+        with open(self.path, "w") as cache_file:
+            json.dump({
+                "index": self.index_version(index),
+                "entries": [[key, stored, results] for key, (stored, results) in self.entries.items()]
+            }, cache_file)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'entries': len(self.entries),
+            'max_entries': self.max_entries
+        }
+
 class BaseSearcher:
 
-    def __init__(self,
-                **kwargs):
+    def __init__(self, kwargs):
+        # kwargs is the dict of the subclass, the arguments of every searcher are
+        # popped so that only the unknown ones are reported as additional arguments
 
         self.interactive = False
-        if kwargs["interactive"]:
+        if kwargs.pop("interactive"):
             self.interactive = True
 
-    def search(self, index, query_tokens, top_k):
+        # queries are boolean expressions (AND, OR, NOT and parentheses)
+        self.boolean = bool(kwargs.pop("boolean", False))
+        # queries can have "quoted phrases" and NEAR/k operators (see parse_query),
+        # otherwise every word of the query is a ranking term (bag of words)
+        self.phrases = bool(kwargs.pop("phrases", False))
+
+        # QueryResultCache shared by the searches (None disables it)
+        self.result_cache = None
+
+    def search(self, index, query_tokens, top_k, boost, candidates=None):
+        """
+        Returns the top_k documents {doc_id: score} for the query tokens
+        If candidates (set of doc ids) is given, only those documents can be returned
+        """
         return NotImplementedError
 
+    def parse_query(self, tokenizer, query):
+        """
+        Parses the query syntax:
+            "protein kinase c" -> the documents must contain the phrase
+            cancer NEAR/5 kinase -> the documents must contain both operands (words or
+                                    phrases) at most 5 positions apart (in any order)
+        Every word of the query (including the ones in phrases) is used for ranking
+        Returns (query_tokens, constraints) where every constraint is a
+        ("phrase", tokens) or ("near", tokens, tokens, k) tuple
+        """
+
+        # operands are ("operand", tokens), NEAR operators are ("near", k)
+        items = []
+        words = []
+        for phrase, near, word in QUERY_ITEMS.findall(query):
+            if near:
+                items.append(("near", int(near)))
+            else:
+                text = phrase or word
+                words.append(text)
+                items.append(("operand", tokenizer.tokenize(text), bool(phrase)))
+
+        query_tokens = self.get_query_tokens(tokenizer, " ".join(words))
+
+        constraints = []
+        for i, item in enumerate(items):
+            if item[0] == "operand" and item[2] and item[1]:
+                constraints.append(("phrase", item[1]))
+            elif item[0] == "near" and 0 < i < len(items) - 1:
+                before, after = items[i - 1], items[i + 1]
+                # the operands of NEAR can't be other operators or only stopwords
+                if before[0] == "operand" and after[0] == "operand" and before[1] and after[1]:
+                    constraints.append(("near", before[1], after[1], item[1]))
+
+        return query_tokens, constraints
+
+    def prepare_query(self, index, tokenizer, query):
+        """
+        Returns the query tokens used for ranking and the set of doc ids that
+        can be returned (None if every document can), according to the phrases
+        and NEAR operators (phrases mode) or the boolean expression (boolean mode)
+        """
+
+        query_tokens, restriction = self.analyze_query(tokenizer, query)
+        return query_tokens, self.restrict(index, restriction)
+
+    def analyze_query(self, tokenizer, query):
+        """
+        Returns the query tokens used for ranking and what restricts the documents
+        that can be returned: the BooleanQuery (boolean mode), the phrase and NEAR
+        constraints (phrases mode) or no constraints (bag of words)
+        """
+
+        if self.boolean:
+            boolean_query = BooleanQuery(tokenizer, query)
+            query_tokens = {}
+            for position, token in enumerate(boolean_query.positive_terms()):
+                query_tokens.setdefault(token, []).append(position)
+            return query_tokens, boolean_query
+
+        if self.phrases:
+            return self.parse_query(tokenizer, query)
+
+        return self.get_query_tokens(tokenizer, query), []
+
+    def restrict(self, index, restriction):
+        """
+        Returns the set of doc ids allowed by the restriction of analyze_query
+        (None if every document is)
+        """
+
+        if isinstance(restriction, BooleanQuery):
+            return set(restriction.evaluate(index))
+        return self.match_constraints(index, restriction)
+
+    def get_ranking_params(self):
+        """
+        Parameters of the ranking that change the scores (part of the result cache keys)
+        """
+        return {}
+
+    def result_cache_key(self, query_tokens, restriction, top_k, boost):
+        """
+        Canonical representation of a search: the bag of query tokens (every token and
+        how many times it occurs), the phrase and NEAR constraints or the boolean
+        expression, the ranking and its parameters, top_k and boost
+        """
+
+        if isinstance(restriction, BooleanQuery):
+            restriction = restriction.tree
+
+        return json.dumps([
+            self.__class__.__name__,
+            self.get_ranking_params(),
+            sorted((token, len(positions)) for token, positions in query_tokens.items()),
+            restriction,
+            top_k,
+            boost
+        ], sort_keys=True)
+
+    def find_phrase(self, index, tokens):
+        """
+        Looks for the phrase (sequence of tokens) in the index
+        Returns {doc_id: positions where the phrase starts}
+        """
+
+        posting_lists = [index.search_token(token) for token in tokens]
+        if not all(posting_lists):
+            return {}
+
+        # only the documents of the smallest posting list need to be checked
+        smallest = min(posting_lists, key=len)
+
+        phrases = {}
+        for doc_id in smallest:
+            if not all(doc_id in posting_list for posting_list in posting_lists):
+                continue
+            starts = phrase_starts(
+                [self.get_positions(posting_list[doc_id][1], index) for posting_list in posting_lists]
+            )
+            if starts:
+                phrases[doc_id] = starts
+        return phrases
+
+    def match_constraints(self, index, constraints):
+        """
+        Returns the set of doc ids that match every phrase and NEAR constraint
+        or None if there are no constraints
+        """
+
+        if not constraints:
+            return None
+
+        candidates = None
+        for constraint in constraints:
+            if constraint[0] == "phrase":
+                documents = set(self.find_phrase(index, constraint[1]))
+            else:
+                _, tokens_a, tokens_b, distance = constraint
+                phrases_a = self.find_phrase(index, tokens_a)
+                phrases_b = self.find_phrase(index, tokens_b)
+                documents = {
+                    doc_id for doc_id, starts_a in phrases_a.items()
+                    if doc_id in phrases_b and
+                    is_near(starts_a, len(tokens_a), phrases_b[doc_id], len(tokens_b), distance)
+                }
+
+            candidates = documents if candidates is None else candidates & documents
+            if not candidates:
+                break
+
+        return candidates
+
     def get_query_tokens(self,tokenizer,query):
         """
         Invokes tokenizer.tokenize function and stores query token positions
@@ -67,15 +374,8 @@ class BaseSearcher:
             print("\n==================")
             query = input("Insert the query: ")
 
-            query_tokens = self.get_query_tokens(tokenizer,query)
-
-            if boost:
-                n_documents = index.get_number_documents()
-                query_tokens = self.high_idf_terms(index,query_tokens,n_documents)
-
-            results = self.search(index, query_tokens, top_k, boost)
-
-            results_list = [ (pmid, score) for pmid,score in dict(results).items() ]
+            # results are identified by doc id, we only need the pmid to present them
+            results_list, _ = self.answer_query(index, tokenizer, query, top_k, boost)
 
             # Paginator variable counter
             current_page = 0
@@ -124,11 +424,13 @@ class BaseSearcher:
                     case _:
                         print("Command not found!")
 
-    def batch_search(self, index, reader, tokenizer, output_file, top_k=1000, boost=None):
+    def batch_search(self, index, reader, tokenizer, output_file, top_k=1000, boost=None, workers=None):
         """
         Function responsible for orchestrating the search process
 
         This function will also keep track of the search metrics (only for non interactive mode)
+        With workers > 1 the questions are searched in parallel by a pool of processes
+        (see parallel_search), the results are written in the order of the questions
         """
 
         if self.interactive:
@@ -147,61 +449,57 @@ class BaseSearcher:
             fmeasure_list = []
             avg_precision_list = []
 
+            tick = time.time()
+            if workers and workers > 1:
+                answered, cache_stats = self.parallel_search(index, reader, tokenizer, top_k, boost, workers)
+            else:
+                # the questions are searched as they are read
+                answered = (
+                    (query, expected_results, *self.answer_query(index, tokenizer, query, top_k, boost))
+                    for query, expected_results in self.read_questions(reader)
+                )
+                cache_stats = None
+
             with open(output_file, 'w+') as output_file:
                 # loop that reads the questions from the QuestionsReader (or other provided reader)
                 # and writes the results to the output file
-
-                # The reader returns a tuple (query_id, query)
-                # where query_id is the id of the query and query is a string
-                query_id, query = reader.read_next_question()
-
-                while query:
-                    
-                    query_tokens = self.get_query_tokens(tokenizer,query)
-
-                    if boost:
-                        n_documents = index.get_number_documents()
-                        query_tokens = self.high_idf_terms(index,query_tokens,n_documents)
-
-                    # search for the query
-                    results = self.search(index, query_tokens, top_k, boost)
-
-                    tock = time.time()
-                    query_latency.append(tock - tick)
+                for query, expected_results, results, latency in answered:
+                    query_latency.append(latency)
 
                     # write results to disk
                     output_file.write(" ".join(query)+"\n")
 
+                    # results are identified by pmid (translated from the doc ids)
                     obtained_results = []
-                    for i, pmid in enumerate(results):
+                    for i, (pmid, weight) in enumerate(results):
                         obtained_results.append(pmid)
                         output_file.write(
-                            f"#{i+1} - {pmid} | weight = {results[pmid]}\n"
+                            f"#{i+1} - {pmid} | weight = {weight}\n"
                         )
                     output_file.write('\n')
 
-                    if reader.has_results:
-                        query_id, results_list = reader.read_current_result()
-
+                    if expected_results is not None:
                         recall_list.append(
-                            mc.calculate_recall(obtained_results, results_list)
+                            mc.calculate_recall(obtained_results, expected_results)
                         )
                         precision_list.append(
-                            mc.calculate_precision(obtained_results, results_list)
+                            mc.calculate_precision(obtained_results, expected_results)
                         )
                         fmeasure_list.append(
-                            mc.calculate_fmeasure(obtained_results, results_list)
+                            mc.calculate_fmeasure(obtained_results, expected_results)
                         )
                         avg_precision_list.append(
-                            mc.calculate_average_precision(obtained_results, results_list)
+                            mc.calculate_average_precision(obtained_results, expected_results)
                         )
-
-
-                    query_id, query = reader.read_next_question()
+            tock = time.time()
 
             # Calculate query throughput
             # query throughput = number of queries / total time spent calculating the results
-            query_throughput = len(query_latency) / sum(query_latency)
+            # the workers search at the same time, so in parallel the elapsed time is used
+            if workers and workers > 1:
+                query_throughput = len(query_latency) / (tock - tick)
+            else:
+                query_throughput = len(query_latency) / sum(query_latency)
 
             # Calculate median query latency
             # median query latency = median of the list of query latencies
@@ -222,11 +520,28 @@ class BaseSearcher:
                 metrics_file.write(f"Query throughput: {query_throughput} q/s\n")
                 metrics_file.write(f"Median query latency: {median_query_latency} s\n")
 
-                # if reader.has_results is true then we know that at least the last
-                # read query had expected results, so the length of the lists won't be 0
-                # which means that we can calculate the metrics, since it won't produce a
-                # division by zero error
-                if reader.has_results:
+                # posting caches of every worker in parallel mode
+                if cache_stats is None:
+                    cache_stats = index.posting_cache.stats()
+                metrics_file.write(
+                    f"Posting cache: {cache_stats['hits']} hits | {cache_stats['misses']} misses | " +
+                    f"{cache_stats['evictions']} evictions | hit rate {cache_stats['hit_rate']:.2f} | " +
+                    f"{cache_stats['size_mb']:.2f}/{cache_stats['max_size_mb']:.2f} MB\n"
+                )
+
+                if self.result_cache is not None:
+                    result_stats = self.result_cache.stats()
+                    metrics_file.write(
+                        f"Result cache: {result_stats['hits']} hits | {result_stats['misses']} misses | " +
+                        f"{result_stats['evictions']} evictions | {result_stats['expirations']} expired | " +
+                        f"hit rate {result_stats['hit_rate']:.2f} | " +
+                        f"{result_stats['entries']}/{result_stats['max_entries']} entries\n"
+                    )
+
+                # the lists are only filled when the reader provides the expected
+                # results, so the length of the lists won't be 0 which means that
+                # we can calculate the metrics, since it won't produce a division by zero error
+                if recall_list:
                     # write average of metrics derived from the expected results
                     metrics_file.write(
                         f"Recall: {(sum(recall_list)/len(recall_list)):.2f}\n"
@@ -241,7 +556,128 @@ class BaseSearcher:
                         f"Avg Precision: {(sum(avg_precision_list)/len(avg_precision_list)):.2f}\n"
                     )
 
-    def boost_scores(self, query, document, boost):
+    @staticmethod
+    def read_questions(reader):
+        """
+        Yields (query, expected results) for every question of the reader,
+        the expected results are None if the reader doesn't provide them
+        """
+
+        # The reader returns a tuple (query_id, query)
+        # where query_id is the id of the query and query is a string
+        _, query = reader.read_next_question()
+        while query:
+            expected_results = None
+            if reader.has_results:
+                _, expected_results = reader.read_current_result()
+            yield query, expected_results
+
+            _, query = reader.read_next_question()
+
+    def answer_query(self, index, tokenizer, query, top_k, boost):
+        """
+        Tokenizes and searches a query (or gets its results from the result cache)
+        Returns the [(pmid, weight)] results and the time spent calculating them (s)
+        """
+
+        tick = time.time()
+
+        # phrases and NEAR operators (or the boolean expression)
+        # restrict the documents that can be returned
+        query_tokens, restriction = self.analyze_query(tokenizer, query)
+
+        key = None
+        if self.result_cache is not None:
+            key = self.result_cache_key(query_tokens, restriction, top_k, boost)
+            cached, results = self.result_cache.get(key)
+            if cached:
+                return results, time.time() - tick
+
+        candidates = self.restrict(index, restriction)
+
+        if boost:
+            n_documents = index.get_number_documents()
+            query_tokens = self.high_idf_terms(index,query_tokens,n_documents)
+
+        # search for the query
+        results = self.search(index, query_tokens, top_k, boost, candidates)
+
+        # results are identified by doc id, so we translate them to pmids
+        results = [(index.get_pmid(doc_id), weight) for doc_id, weight in results.items()]
+
+        tock = time.time()
+
+        if key is not None:
+            self.result_cache.put(key, results)
+
+        return results, tock - tick
+
+    def parallel_search(self, index, reader, tokenizer, top_k, boost, workers):
+        """
+        Searches every question with a pool of worker processes, each worker loads
+        the index once (its own files and posting list cache) and answers chunks of questions.
+        Returns the [(query, expected results, results, latency)] in the order of the
+        questions and the posting cache statistics of the workers added together
+        """
+
+        questions = list(self.read_questions(reader))
+
+        # the result cache is checked here and only the other questions are sent to the workers
+        # (repeated questions of the same batch are searched by the workers)
+        cached_answers = {}
+        keys = {}
+        if self.result_cache is not None:
+            for i, (query, _) in enumerate(questions):
+                tick = time.time()
+                key = self.result_cache_key(*self.analyze_query(tokenizer, query), top_k, boost)
+                cached, results = self.result_cache.get(key)
+                if cached:
+                    cached_answers[i] = (results, time.time() - tick)
+                else:
+                    keys[i] = key
+        missing = [i for i in range(len(questions)) if i not in cached_answers]
+
+        answers = []
+        if missing:
+            posting_cache_mb = index.posting_cache.max_size / (1<<20)
+            context = multiprocessing.get_context("fork")
+            with context.Pool(
+                workers,
+                initializer=init_search_worker,
+                initargs=(self, index.__class__, index.path_to_folder, posting_cache_mb, tokenizer, top_k, boost)
+            ) as pool:
+                # imap keeps the order of the questions
+                chunksize = max(1, len(missing) // (workers * 4))
+                answers = list(pool.imap(
+                    search_worker, [questions[i][0] for i in missing], chunksize=chunksize
+                ))
+
+        worker_cache_stats = {}
+        for i, (pid, results, latency, cache_stats) in zip(missing, answers):
+            cached_answers[i] = (results, latency)
+            if i in keys:
+                self.result_cache.put(keys[i], results)
+            # the statistics are cumulative, so the last ones of each worker are kept
+            worker_cache_stats[pid] = cache_stats
+
+        answered = [
+            (query, expected_results, *cached_answers[i])
+            for i, (query, expected_results) in enumerate(questions)
+        ]
+
+        cache_stats = {
+            key: sum(stats[key] for stats in worker_cache_stats.values())
+            for key in ('hits', 'misses', 'evictions', 'size_mb', 'max_size_mb')
+        }
+        lookups = cache_stats['hits'] + cache_stats['misses']
+        cache_stats['hit_rate'] = cache_stats['hits'] / lookups if lookups else 0
+        if not worker_cache_stats:
+            # every question was in the result cache
+            cache_stats = index.posting_cache.stats()
+
+        return answered, cache_stats
+
+    def boost_scores(self, query, document, boost, index=None):
         """
         This function is responsible for boosting the scores of the documents
         that contain all the query terms (and not only some of them)
@@ -264,7 +700,7 @@ class BaseSearcher:
         # If document contains all distinct query terms, apply boost factor
         if num_distinct_terms == len(set(query)):
             # Create a list of lists with the positions of each query term in the document
-            token_positions = [ loads(data[1]) for data in document.values() ]
+            token_positions = [ self.get_positions(data[1], index) for data in document.values() ]
             min_window_size = self.find_min_window(token_positions)
 
             if num_distinct_terms == min_window_size:
@@ -274,6 +710,54 @@ class BaseSearcher:
 
         return boost_factor
 
+    @staticmethod
+    def get_positions(positions, index=None):
+        """
+        Text indexes return the positions as a "[p1,p2,...]" string,
+        binary indexes return them already decoded as a list
+        and indexes with separate positions return their offset in the positions
+        file (a string or an int), which is only read here
+        """
+        if isinstance(positions, str):
+            return loads(positions) if positions[0] == "[" else index.read_positions(int(positions))
+        if isinstance(positions, int):
+            return index.read_positions(positions)
+        return positions
+
+    @staticmethod
+    def get_candidates(matched, candidates):
+        """
+        Doc ids of the documents that matched the query (boolean array indexed by doc id)
+        that are also in candidates (set of doc ids, None means every document)
+        """
+
+        if candidates is not None:
+            allowed = np.zeros(len(matched), dtype=bool)
+            allowed[np.fromiter(candidates, dtype=np.int64, count=len(candidates))] = True
+            matched &= allowed
+        return np.flatnonzero(matched)
+
+    @staticmethod
+    def select_top_k(scores, candidates, top_k):
+        """
+        Selects the top_k documents of a dense score array (indexed by doc id)
+        among the candidates (doc ids of the documents that matched the query)
+        with a partial selection (argpartition) instead of sorting every candidate
+        Returns {doc_id: score} in decreasing order (ties broken by the smallest doc id)
+        """
+
+        candidate_scores = scores[candidates]
+        if top_k < len(candidates):
+            best = np.argpartition(-candidate_scores, top_k - 1)[:top_k]
+            candidates = candidates[best]
+            candidate_scores = candidate_scores[best]
+
+        order = np.lexsort((candidates, -candidate_scores))
+        return {
+            int(doc_id): float(score)
+            for doc_id, score in zip(candidates[order], candidate_scores[order])
+        }
+
     def high_idf_terms(self, index, query_tokens, n_documents):
         """
         This function is responsible to consider only high IDF terms when finding
@@ -326,33 +810,33 @@ class BaseSearcher:
         idf = log10( int(n_documents) / df )
         return idf
 
-    def combinations(self, lists):
+    def find_min_window(self, positions):
         """
-        Generate all possible combinations using itertools
-        Using yield instead of return to avoid memory issues and improve performance
+        Looks for the minimum window size in the given positions
+        with the sorted merge (sliding window) algorithm of proximity.min_cover
 
-        input: list of integer lists, example lists= [[1, 2, 3], [4, 5], [6, 7]]
+        input (positions): list of integer lists, example positions= [[1, 2, 3], [4, 5], [6, 7]
         """
-        for comb in itertools.product(*lists):
-            yield comb
+        return min_window_size(positions)
 
-    def find_min_window(self, positions):
+    def find_min_window_positions(self, query, document, index=None):
+        """
+        Returns the minimum window of the document that contains every query term
+        as (start, end, {token: position}), which can be used to highlight the
+        terms or by phrase features, or None if the document doesn't have every term
+        document = {'token': (weight, positions)}
         """
-        Looks for the minimum window size in the given positions
-        using the brute force approach (inspirado no trabalho de AA)
 
-        (Although this method is not the best performing one, it was the most accurate one)
+        if any(token not in document for token in query):
+            return None
 
-        input (positions): list of integer lists, example positions= [[1, 2, 3], [4, 5], [6, 7]
-        """
-        min_window = float("inf")
-        for comb in self.combinations(positions):
-            # +1 because we want the window size, not the
-            # distance between the last and first element
-            window = max(comb) - min(comb) + 1
-            if window < min_window:
-                min_window = window
-        return min_window
+        tokens = list(query)
+        cover = min_cover([self.get_positions(document[token][1], index) for token in tokens])
+        if cover is None:
+            return None
+
+        start, end, positions = cover
+        return start, end, dict(zip(tokens, positions))
 
     def compute_normal_index(self, posting_lists):
         """
@@ -380,7 +864,7 @@ class TFIDFRanking(BaseSearcher):
     """
 
     def __init__(self, smart, **kwargs) -> None:
-        super().__init__(**kwargs)
+        super().__init__(kwargs)
         self.smart = smart
         self.pivot = None
         # this should be tested, but for now we will use the value ranked as best in the paper
@@ -391,6 +875,9 @@ class TFIDFRanking(BaseSearcher):
                 f"{self.__class__.__name__} also caught the following additional arguments {kwargs}"
             )
 
+    def get_ranking_params(self):
+        return {'smart': self.smart}
+
     def calc_term_frequency(self, positions):
         """
         Returns the term frequency based on the smart notation
@@ -423,7 +910,7 @@ class TFIDFRanking(BaseSearcher):
         if doc_frequency_letter == 'n':
             return 1
         if doc_frequency_letter == 't':
-            if not posting_list:
+            if posting_list is None or len(posting_list) == 0:
                 return 0
             return log10(n_documents/len(posting_list))
         if doc_frequency_letter == 'p':
@@ -459,23 +946,22 @@ class TFIDFRanking(BaseSearcher):
         """
         Based on the normalization method returns a dictionary with
         doc_id: norm
+        The norms of every document are loaded only once by the index,
+        here we only pick the ones of the documents in normal_index
         """
 
         if normalization_letter == 'n':
             return {doc_id: 1 for doc_id in normal_index.keys()}
-        if normalization_letter == 'c':
-            return index.read_norm_file()
-        if normalization_letter == 'u':
-            unique_counts = index.read_unique_counts_file()
-            self.pivot = sum([n_unique for _, n_unique in unique_counts.items()]) / len(unique_counts)
-            return {
-                doc_id: (1.0 - self.slope) * self.pivot + self.slope * n_unique
-                for doc_id, n_unique in unique_counts.items()
-            }
+        if normalization_letter in ('c', 'u'):
+            if normalization_letter == 'u':
+                # the pivot is stored in the index metadata
+                self.pivot = index.pivot
+                self.slope = index.slope
+            return {doc_id: index.doc_norms[doc_id] for doc_id in normal_index.keys()}
         else:
             raise NotImplementedError
 
-    def search(self, index, query_tokens, top_k, boost):
+    def search(self, index, query_tokens, top_k, boost, candidates=None):
         """
         Get the top_k documents for query
         """
@@ -493,6 +979,10 @@ class TFIDFRanking(BaseSearcher):
 
         # compute "normal" index
         normal_index = self.compute_normal_index(posting_lists)
+        if candidates is not None:
+            normal_index = {
+                doc_id: doc_tokens for doc_id, doc_tokens in normal_index.items() if doc_id in candidates
+            }
 
         # get doc norms
         doc_norms = self.get_doc_norms(
@@ -514,6 +1004,10 @@ class TFIDFRanking(BaseSearcher):
             normalization_letter = self.smart.split('.')[1][2]
         )
 
+        # none of the query tokens is in the index
+        if not query_normalized_weight:
+            return {}
+
         normalized_tokens={}
         for token, weight in tokens_weights.items():
             normalized_tokens[token] = weight/query_normalized_weight
@@ -534,7 +1028,7 @@ class TFIDFRanking(BaseSearcher):
 
             # Get boosted score of the document (optional)
             if boost:
-                doc_weights[doc_id] *= self.boost_scores(query_tokens, doc_tokens, boost)
+                doc_weights[doc_id] *= self.boost_scores(query_tokens, doc_tokens, boost, index)
 
 
         # Now we sort the documents by weight and choose the top_k
@@ -553,34 +1047,159 @@ class TFIDFRanking(BaseSearcher):
             })
         return { result['doc_id'] : result['weight'] for result in results }
 
+class VectorizedTFIDFRanking(TFIDFRanking):
+    """
+    TFIDF (SMART notation) ranking with numpy: the stored document weights of each
+    query token (decoded into arrays) are multiplied by the normalized query weight,
+    divided by the precomputed document norms and scatter-added into a dense array
+    of scores indexed by doc id, the top k is selected with argpartition.
+    The operations are the same as TFIDFRanking.search (in float64), so the rankings are too
+    """
+
+    def search(self, index, query_tokens, top_k, boost, candidates=None):
+
+        # the boost needs the positions of every query token in each document
+        if boost:
+            return super().search(index, query_tokens, top_k, boost, candidates)
+
+        n_documents = int(index.n_documents)
+        document_smart, query_smart = self.smart.split('.')
+
+        # document norms (indexed by doc id)
+        doc_norms = None
+        if document_smart[2] in ('c', 'u'):
+            if document_smart[2] == 'u':
+                # the pivot is stored in the index metadata
+                self.pivot = index.pivot
+                self.slope = index.slope
+            doc_norms = np.frombuffer(index.doc_norms, dtype=np.float64)
+        elif document_smart[2] != 'n':
+            raise NotImplementedError
+
+        # (doc ids, weights) of each token
+        posting_arrays = {token: index.search_token_arrays(token) for token in query_tokens}
+
+        # query weights
+        tokens_weights = {}
+        for token, positions in query_tokens.items():
+            doc_ids = posting_arrays[token][0] if posting_arrays[token] is not None else None
+            tokens_weights[token] = self.calc_term_frequency(positions) * \
+                self.calc_document_frequency(posting_list=doc_ids, n_documents=n_documents)
+
+        query_normalized_weight = self.normalize_weights(
+            weights = list(tokens_weights.values()),
+            normalization_letter = query_smart[2]
+        )
+
+        # none of the query tokens is in the index
+        if not query_normalized_weight:
+            return {}
+
+        scores = np.zeros(n_documents, dtype=np.float64)
+        matched = np.zeros(n_documents, dtype=bool)
+
+        for token, weight in tokens_weights.items():
+            if posting_arrays[token] is None:
+                continue
+
+            doc_ids, doc_weights = posting_arrays[token]
+            token_scores = weight/query_normalized_weight * doc_weights
+            if doc_norms is not None:
+                token_scores = token_scores / doc_norms[doc_ids]
+
+            # doc ids are unique in a posting list, so fancy indexing accumulates correctly
+            scores[doc_ids] += token_scores
+            matched[doc_ids] = True
+
+        return self.select_top_k(scores, self.get_candidates(matched, candidates), top_k)
+
 class BM25Ranking(BaseSearcher):
     """
     This class is responsible for searching and ranking documents based on a bm25 weighted index
     """
 
-    def __init__(self, k1, b, **kwargs) -> None:
-        super().__init__(**kwargs)
+    def __init__(self, k1=None, b=None, pruning="none", **kwargs) -> None:
+        super().__init__(kwargs)
+        # None -> DEFAULT_BM25_K1 and DEFAULT_BM25_B, or the k1 and b of the index
+        # (the ones of its max scores) when the search is pruned
         self.k1 = k1
         self.b = b
-        print("init BM25Ranking|", f"{k1=}", f"{b=}")
+        # wand -> dynamic pruning (only the documents that can enter the top k are scored)
+        # bmw -> Block-Max WAND, wand that also skips blocks of postings using their max scores
+        # none -> every posting of every query token is scored
+        self.pruning = pruning
+        # indexes with precomputed impacts were already warned about different k1 and b
+        self.warned_impacts = False
+        # indexes without max scores for the k1 and b were already warned that they can't be pruned
+        self.warned_pruning = False
+        print("init BM25Ranking|", f"{k1=}", f"{b=}", f"{pruning=}")
         if kwargs:
             print(
                 f"{self.__class__.__name__} also caught the following additional arguments {kwargs}"
             )
 
-    def search(self, index, query_tokens, top_k, boost):
+    def get_ranking_params(self):
+        # the pruning doesn't change the results (the top k is exact)
+        return {'k1': self.k1, 'b': self.b}
+
+    def get_bm25_params(self, index):
+        """
+        Returns the k1 and b used to score the index: the ones of this ranker, or when
+        they are not given DEFAULT_BM25_K1 and DEFAULT_BM25_B (the ones of the index
+        if the search is pruned, so its max scores can be used)
+        Indexes with precomputed impacts (--indexer.bm25.impacts) were scored with the k1 and b
+        of the indexer, warns (once) if they are not the ones of this ranker
+        """
+
+        default_k1, default_b = DEFAULT_BM25_K1, DEFAULT_BM25_B
+        if self.pruning in ("wand", "bmw") and index.bm25_k1 is not None:
+            default_k1, default_b = index.bm25_k1, index.bm25_b
+        k1 = self.k1 if self.k1 is not None else default_k1
+        b = self.b if self.b is not None else default_b
+
+        if not index.bm25_impacts:
+            return k1, b
+
+        if (k1, b) != (index.bm25_k1, index.bm25_b) and not self.warned_impacts:
+            print(
+                f"WARNING: the index has BM25 impacts precomputed with k1={index.bm25_k1} and " +
+                f"b={index.bm25_b}, the ranker's k1={k1} and b={b} are ignored"
+            )
+            self.warned_impacts = True
+
+        return index.bm25_k1, index.bm25_b
+
+    def search(self, index, query_tokens, top_k, boost, candidates=None):
+
+        k1, b = self.get_bm25_params(index)
+
+        # the boost depends on the positions of every query token in the document,
+        # so boosted queries are always scored exhaustively
+        if self.pruning in ("wand", "bmw") and not boost:
+            results = self.search_wand(
+                index, query_tokens, top_k, block_max=self.pruning == "bmw", candidates=candidates
+            )
+            if results is not None:
+                return results
+
+            if not self.warned_pruning:
+                print(
+                    f"WARNING: the index has no BM25 max scores for k1={k1} and b={b} (it was built " +
+                    f"with k1={index.bm25_k1} and b={index.bm25_b}), the {self.pruning} pruning " +
+                    "is disabled and every posting is scored"
+                )
+                self.warned_pruning = True
 
         # Dictionary to store the bm25 ranking of each publication, according to the current query
         pub_scores = {}
 
-        # avg_pub_length -> average length of the publications
         # n_documents -> total number of documents/publications
-        # pubs_length -> dictionary containing the pmid as key and 
-        # the length of the publications as value
-        parameters = index.get_pubs_length()
-        avg_pub_length = float(parameters['pub_avg_length'])
-        n_documents = int(parameters['n_documents'])
-        pubs_length = parameters['pubs_length']
+        # length_norms -> k1 * ((1 - b) + b * pub_length/avg_pub_length) of every publication
+        # (indexed by doc id), loaded and computed only once by the index
+        # indexes with precomputed impacts already have the bm25 score of every posting
+        n_documents = int(index.n_documents)
+        impacts = index.bm25_impacts is not None
+        length_norms = index.get_bm25_length_norms(k1, b) if not impacts else None
 
         # posting_lists = {'token': {'doc_id': no_normalized_weight}}
         posting_lists = {}
@@ -601,11 +1220,16 @@ class BM25Ranking(BaseSearcher):
             # Iterating each publication in the postings list and update its BM25 score
             for pub_id, data in postings_list.items():
 
-                positions = loads(data[1])
+                if candidates is not None and pub_id not in candidates:
+                    continue
 
-                score = self.calculate_bm25(
-                    idf, len(positions), self.k1, self.b, pubs_length[pub_id], avg_pub_length
-                )
+                if impacts:
+                    score = data[0]
+                else:
+                    # the bm25 weight is the tf, the positions are not needed
+                    score = self.calculate_bm25(
+                        idf, int(data[0]), k1, length_norms[pub_id]
+                    )
 
                 # Add score to pub_scores. Note: if a token is repeated two times in a query,
                 # the score is going to be multiplied by 2
@@ -616,20 +1240,219 @@ class BM25Ranking(BaseSearcher):
 
                 # Get boosted score of the document (optional)
                 if boost:
-                    pub_scores[pub_id] *= self.boost_scores(query_tokens, normal_index[pub_id], boost)
+                    pub_scores[pub_id] *= self.boost_scores(query_tokens, normal_index[pub_id], boost, index)
 
         # Using heapq.nlargest to find the k best scored publications in decreasing order
-        top_k_pubs = nlargest(top_k, pub_scores.keys(), key=lambda k: pub_scores[k])
+        # (ties are broken by the smallest doc id, like in search_wand)
+        top_k_pubs = nlargest(top_k, pub_scores.keys(), key=lambda k: (pub_scores[k], -k))
 
-        # Return top-k pmid : pub_score
-        return { pmid : pub_scores[pmid] for pmid in top_k_pubs }
+        # Return top-k doc_id : pub_score
+        return { doc_id : pub_scores[doc_id] for doc_id in top_k_pubs }
 
-    def calculate_bm25(self, idf, tf, k1, b, pub_length, avg_pub_length):
+    def search_wand(self, index, query_tokens, top_k, block_max=False, candidates=None):
+        """
+        Top-k BM25 search with the WAND dynamic pruning algorithm.
+        Every query token has a cursor over its stored postings (ScoredPostingCursor) and
+        an upper bound of its score (max score of the term * query tf). The cursors are
+        kept sorted by their current doc id and the pivot is the first cursor where
+        the sum of the upper bounds exceeds the score of the k-th best document.
+        No document before the pivot doc id can enter the top k, so the cursors jump
+        to it (shallow_advance, nothing is decoded), the blocks of postings where they
+        land are only decoded when the pivot doc is scored and only the documents
+        that can enter the top k are scored.
+
+        With block_max (Block-Max WAND) the pivot is also checked against the max
+        scores of the blocks of postings that may contain it (read from block_max.bin),
+        and when even those can't beat the k-th best document the cursors jump over
+        the whole blocks without decoding them.
+        Returns exactly the same top k as the exhaustive search, or None if the index
+        doesn't have the max scores of the terms for the k1 and b of the ranking
+        """
+
+        k1, b = self.get_bm25_params(index)
+        if index.term_dictionary is None or (k1, b) != (index.bm25_k1, index.bm25_b):
+            return None
+        if top_k <= 0:
+            return {}
+
+        n_documents = int(index.n_documents)
+        impacts = index.bm25_impacts is not None
+        length_norms = index.get_bm25_length_norms(k1, b) if not impacts else None
+
+        # term = [cursor, upper bound, query token order, idf, query tf,
+        #         last doc id of each block, upper bound of each block, current block]
+        terms = []
+        for order, (query_token, query_positions) in enumerate(query_tokens.items()):
+            max_score = index.get_max_score(query_token, k1, b)
+            cursor = index.open_cursor(query_token, weights=True) if max_score is not None else None
+            if cursor is None:
+                continue
+
+            idf = self.calculate_idf(cursor, n_documents)
+            query_tf = len(query_positions)
+
+            # a small margin is added to the upper bounds so the float rounding
+            # of the sums never prunes a valid document
+            block_max_scores = index.get_block_max_scores(query_token, k1, b) \
+                if block_max else None
+            if block_max_scores is None:
+                # a single block with every posting (same as WAND)
+                block_max_scores = ([cursor.skip_last_docs[-1]], [max_score])
+            block_last_docs, block_max_scores = block_max_scores
+            block_upper_bounds = [score * query_tf * (1 + 1e-9) for score in block_max_scores]
+
+            cursor.advance(0)
+            terms.append([
+                cursor, max_score * query_tf * (1 + 1e-9), order, idf, query_tf,
+                block_last_docs, block_upper_bounds, 0
+            ])
+
+        # min heap with the best (score, -doc id) found so far
+        top_pubs = []
+        threshold = -1.0
+
+        while terms:
+            terms.sort(key=lambda term: term[0].doc)
+
+            # find the pivot
+            pivot = None
+            upper_bound = 0
+            for i, term in enumerate(terms):
+                upper_bound += term[1]
+                if upper_bound > threshold:
+                    pivot = i
+                    break
+
+            # not even all the tokens together can beat the k-th best document
+            if pivot is None:
+                break
+
+            pivot_doc = terms[pivot][0].doc
+            # the cursors after the pivot that are also in the pivot doc are part of it
+            while pivot + 1 < len(terms) and terms[pivot + 1][0].doc == pivot_doc:
+                pivot += 1
+
+            if block_max:
+                # find the block that may hold the pivot doc of the cursors up to the pivot
+                # (a cursor whose postings all come before the pivot doc has no such block)
+                upper_bound = 0
+                for term in terms[:pivot + 1]:
+                    term[7] = bisect_left(term[5], pivot_doc, term[7])
+                    if term[7] < len(term[5]):
+                        upper_bound += term[6][term[7]]
+
+                if upper_bound <= threshold:
+                    # no document until the end of the smallest of these blocks (or
+                    # the doc of the next cursor) can enter the top k, skip them
+                    next_doc = min(
+                        term[5][term[7]] for term in terms[:pivot + 1] if term[7] < len(term[5])
+                    ) + 1
+                    if pivot + 1 < len(terms):
+                        next_doc = min(next_doc, terms[pivot + 1][0].doc)
+
+                    for term in terms[:pivot + 1]:
+                        term[0].shallow_advance(next_doc)
+
+                    terms = [term for term in terms if term[0].doc is not None]
+                    continue
+
+            if terms[0][0].doc != pivot_doc:
+                # no document before the pivot doc can enter the top k
+                for term in terms[:pivot]:
+                    term[0].shallow_advance(pivot_doc)
+
+            elif any(term[0].shallow for term in terms[:pivot + 1]):
+                # decode the blocks of the cursors that are only at a lower bound of their doc id,
+                # the pivot doc is scored in the next iteration if they are all still in it
+                for term in terms[:pivot + 1]:
+                    if term[0].shallow:
+                        term[0].advance(term[0].doc)
+
+            elif candidates is not None and pivot_doc not in candidates:
+                # the pivot doc can't be returned, skip it
+                for term in terms[:pivot + 1]:
+                    term[0].next()
+
+            else:
+                # every cursor up to the pivot is in the pivot doc, score it.
+                # the scores are added in the query order, like the exhaustive search
+                score = 0
+                for term in sorted(terms[:pivot + 1], key=lambda term: term[2]):
+                    if impacts:
+                        score += term[0].weight() * term[4]
+                    else:
+                        score += self.calculate_bm25(
+                            term[3], int(term[0].weight()), k1, length_norms[pivot_doc]
+                        ) * term[4]
+
+                if len(top_pubs) < top_k:
+                    heappush(top_pubs, (score, -pivot_doc))
+                elif (score, -pivot_doc) > top_pubs[0]:
+                    heapreplace(top_pubs, (score, -pivot_doc))
+
+                # documents are visited in increasing doc id order, so a later document
+                # with the same score as the k-th best never enters the top k
+                if len(top_pubs) == top_k:
+                    threshold = top_pubs[0][0]
+
+                for term in terms[:pivot + 1]:
+                    term[0].next()
+
+            terms = [term for term in terms if term[0].doc is not None]
+
+        # Return top-k doc_id : pub_score in decreasing order
+        return { -doc_id : score for score, doc_id in sorted(top_pubs, reverse=True) }
+
+    def calculate_bm25(self, idf, tf, k1, length_norm):
         """
         Calculates bm25 formula for a publication given a query token
+        length_norm is the publication's k1 * ( (1 - b) + b * (pub_length/avg_pub_length) )
         """
         coefficient = idf
         nominator = tf * (k1 + 1)
-        denominator = tf + k1 * ( (1 - b) + b * (int(pub_length)/avg_pub_length) )
+        denominator = tf + length_norm
         return coefficient * ( nominator / denominator )
 
+
+class VectorizedBM25Ranking(BM25Ranking):
+    """
+    BM25 ranking that scores one query token at a time with numpy:
+    the postings of each token are decoded into arrays (doc ids, tfs), scored against
+    the length normalization of every publication in one operation and accumulated
+    into a dense float32 array of scores, the top k is selected with argpartition
+    """
+
+    def search(self, index, query_tokens, top_k, boost, candidates=None):
+
+        # the boost needs the positions of every query token in each document
+        if boost:
+            return super().search(index, query_tokens, top_k, boost, candidates)
+
+        n_documents = int(index.n_documents)
+        k1, b = self.get_bm25_params(index)
+        impacts = index.bm25_impacts is not None
+        # zero copy view of the length normalization of every publication (array of doubles)
+        length_norms = np.frombuffer(index.get_bm25_length_norms(k1, b), dtype=np.float64) \
+            if not impacts else None
+
+        scores = np.zeros(n_documents, dtype=np.float32)
+        matched = np.zeros(n_documents, dtype=bool)
+
+        for query_token, query_positions in query_tokens.items():
+            arrays = index.search_token_arrays(query_token)
+            if arrays is None:
+                continue
+
+            doc_ids, weights = arrays
+            if impacts:
+                token_scores = weights
+            else:
+                # weights are the tfs, same formula as calculate_bm25
+                idf = log10(n_documents / len(doc_ids))
+                token_scores = idf * ( (weights * (k1 + 1)) / (weights + length_norms[doc_ids]) )
+
+            # doc ids are unique in a posting list, so fancy indexing accumulates correctly
+            scores[doc_ids] += token_scores * len(query_positions)
+            matched[doc_ids] = True
+
+        return self.select_top_k(scores, self.get_candidates(matched, candidates), top_k)
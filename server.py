@@ -0,0 +1,295 @@
+"""
+Authors:
+Gonçalo Leal - 98008
+Ricardo Rodriguez - 98388
+
+Query server (main.py server), the index is loaded once and the queries
+are answered over HTTP (TCP or unix socket) with asyncio.
+
+Endpoints:
+    POST /search   {"query": "...", "top_k": 10, "boost": null, "boolean": false, "phrases": false,
+                    "ranking": {"class": "BM25Ranking", "k1": 1.2, "b": 0.6}}
+                   every field except the query is optional (the server defaults are used)
+                   -> {"query": "...", "results": [{"pmid": "...", "score": 1.2}, ...], "latency": 0.01}
+    GET  /health   -> {"status": "ok"}
+    GET  /stats    -> number of requests, latencies, posting cache and result cache statistics
+
+The index and its posting list cache are not thread safe, so the searches run one
+at a time in a single thread and the event loop keeps accepting connections (and
+answering /health) while a search runs. At most max_concurrency searches are
+accepted at the same time (running or waiting), the others are rejected with 503.
+Invalid requests are answered with 400 and unexpected errors with 500.
+"""
+
+import asyncio
+import json
+import statistics
+import time
+import traceback
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from searcher import dynamically_init_searcher
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    500: "Internal Server Error",
+    503: "Service Unavailable"
+}
+
+# ranker classes that a request can choose: { class : (weight method of the index, parameters) }
+RANKERS = {
+    "BM25Ranking": ("bm25", {"k1", "b", "pruning"}),
+    "VectorizedBM25Ranking": ("bm25", {"k1", "b", "pruning"}),
+    "TFIDFRanking": ("tfidf", {"smart"}),
+    "VectorizedTFIDFRanking": ("tfidf", {"smart"})
+}
+PRUNINGS = ("none", "wand", "bmw")
+
+
+class QueryServer:
+
+    def __init__(self, index, tokenizer, ranking_kwargs, top_k=10, max_concurrency=8, result_cache=None,
+                 max_rankers=16):
+        self.index = index
+        self.tokenizer = tokenizer
+        # ranking used when the request doesn't choose one
+        self.ranking_kwargs = ranking_kwargs
+        self.top_k = top_k
+        self.max_concurrency = max_concurrency
+
+        # single thread where the searches run
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # { (ranking kwargs, boolean, phrases) : ranker }, a ranker is created once for each ranking,
+        # the rankings come from the clients so only the max_rankers most recently used are kept
+        self.rankers = OrderedDict()
+        self.max_rankers = max_rankers
+        # QueryResultCache shared by every ranker (its keys have the ranking parameters)
+        self.result_cache = result_cache
+
+        # statistics
+        self.started = time.time()
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_rejected = 0
+        self.in_flight = 0
+        # latency of the most recent searches (s)
+        self.latencies = deque(maxlen=1000)
+
+        print("init QueryServer|", f"{top_k=}, {max_concurrency=}")
+
+    def get_ranker(self, ranking, boolean, phrases):
+        """
+        Returns the ranker of the request, its parameters are added to the
+        default ones unless it chooses another ranking class
+        Only the RANKERS classes and their parameters are accepted, and the
+        class must rank the weights of the index
+        """
+
+        kwargs = dict(self.ranking_kwargs)
+        if ranking:
+            if not isinstance(ranking, dict):
+                raise ValueError("ranking must be an object")
+            if ranking.get("class", kwargs["class"]) != kwargs["class"]:
+                kwargs = {}
+            kwargs.update(ranking)
+
+        ranker_class = kwargs.get("class")
+        if ranker_class not in RANKERS:
+            raise ValueError(f"unknown ranking class {ranker_class!r}, expected one of {', '.join(RANKERS)}")
+        weight_method, params = RANKERS[ranker_class]
+        if weight_method != self.index.weight_method:
+            raise ValueError(
+                f"{ranker_class} ranks {weight_method} indexes, the index is {self.index.weight_method}"
+            )
+        unknown = set(kwargs) - params - {"class"}
+        if unknown:
+            raise ValueError(
+                f"unknown {ranker_class} parameters {', '.join(sorted(unknown))}, " +
+                f"expected {', '.join(sorted(params))}"
+            )
+
+        if kwargs.get("pruning", "none") not in PRUNINGS:
+            raise ValueError(f"pruning must be one of {', '.join(PRUNINGS)}")
+        if "smart" in kwargs and not isinstance(kwargs["smart"], str):
+            raise ValueError("smart must be a string")
+        # null k1 and b are the ranker's defaults
+        for name in ("k1", "b"):
+            if kwargs.get(name) is not None and (isinstance(kwargs[name], bool) or
+                                                 not isinstance(kwargs[name], (int, float)) or kwargs[name] < 0):
+                raise ValueError(f"{name} must be a non negative number")
+        if kwargs.get("b") is not None and kwargs["b"] > 1:
+            raise ValueError("b must be between 0 and 1")
+
+        key = (json.dumps(kwargs, sort_keys=True), boolean, phrases)
+        if key in self.rankers:
+            self.rankers.move_to_end(key)
+            return self.rankers[key]
+
+        ranker = dynamically_init_searcher(
+            interactive=False, boolean=boolean, phrases=phrases, **kwargs
+        )
+        ranker.result_cache = self.result_cache
+        self.rankers[key] = ranker
+        while len(self.rankers) > self.max_rankers:
+            self.rankers.popitem(last=False)
+        return ranker
+
+    def search(self, request):
+        """
+        Answers a search request (runs in the search thread)
+        """
+
+        query = request["query"]
+        if not isinstance(query, str) or not query.strip():
+            raise ValueError("the query must be a non empty string")
+
+        top_k = request.get("top_k")
+        if top_k is None:
+            top_k = self.top_k
+        if isinstance(top_k, bool) or not isinstance(top_k, int) or top_k <= 0:
+            raise ValueError("top_k must be a positive integer")
+
+        boost = request.get("boost")
+        if boost is not None and (isinstance(boost, bool) or
+                                  not isinstance(boost, (int, float)) or boost <= 0):
+            raise ValueError("boost must be a positive number")
+
+        ranker = self.get_ranker(
+            request.get("ranking"), bool(request.get("boolean")), bool(request.get("phrases"))
+        )
+
+        results, latency = ranker.answer_query(self.index, self.tokenizer, query, top_k, boost)
+        self.latencies.append(latency)
+
+        return {
+            "query": query,
+            "results": [{"pmid": pmid, "score": float(score)} for pmid, score in results],
+            "latency": latency
+        }
+
+    def stats(self):
+        return {
+            "uptime": time.time() - self.started,
+            "requests": self.n_requests,
+            "errors": self.n_errors,
+            "rejected": self.n_rejected,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "median_latency": statistics.median(self.latencies) if self.latencies else None,
+            "rankers": [
+                dict(json.loads(kwargs), boolean=boolean, phrases=phrases)
+                for kwargs, boolean, phrases in self.rankers
+            ],
+            "n_documents": int(self.index.n_documents),
+            "posting_cache": self.index.posting_cache.stats(),
+            "result_cache": self.result_cache.stats() if self.result_cache is not None else None
+        }
+
+    async def route(self, method, path, body):
+        """
+        Returns the (status, response) of a request
+        """
+
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+
+        if method == "GET" and path == "/stats":
+            return 200, self.stats()
+
+        if path != "/search":
+            return 404, {"error": f"unknown endpoint {method} {path}"}
+
+        if method != "POST":
+            return 400, {"error": "searches must be POST requests"}
+
+        self.n_requests += 1
+
+        # the event loop runs in a single thread, so the counter needs no lock
+        if self.in_flight >= self.max_concurrency:
+            self.n_rejected += 1
+            return 503, {"error": "too many requests"}
+
+        self.in_flight += 1
+        try:
+            request = json.loads(body)
+            response = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.search, request
+            )
+            return 200, response
+        except (KeyError, TypeError, ValueError, AttributeError, NotImplementedError) as error:
+            # bad json, missing query, invalid or unsupported ranking parameters
+            self.n_errors += 1
+            return 400, {"error": f"{error.__class__.__name__}: {error}"}
+        except Exception as error:
+            self.n_errors += 1
+            traceback.print_exc()
+            return 500, {"error": f"{error.__class__.__name__}: {error}"}
+        finally:
+            self.in_flight -= 1
+
+    async def handle_connection(self, reader, writer):
+        """
+        Reads an HTTP request, answers it and closes the connection
+        """
+
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                writer.close()
+                return
+
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            status, response = await self.route(method, path.split("?", 1)[0], body)
+        except (ValueError, asyncio.IncompleteReadError):
+            status, response = 400, {"error": "malformed HTTP request"}
+        except ConnectionError:
+            # the client is gone, there is no one to answer
+            writer.close()
+            return
+        except Exception as error:
+            traceback.print_exc()
+            status, response = 500, {"error": f"{error.__class__.__name__}: {error}"}
+
+        data = json.dumps(response).encode("utf-8")
+        writer.write(
+            (f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n" +
+            "Content-Type: application/json\r\n" +
+            f"Content-Length: {len(data)}\r\n" +
+            "Connection: close\r\n\r\n").encode("latin-1") + data
+        )
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080, unix_socket=None):
+        if unix_socket:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+
+        print(f"Serving on {unix_socket if unix_socket else f'http://{host}:{port}'}")
+        async with server:
+            await server.serve_forever()
+
+    def run(self, host="127.0.0.1", port=8080, unix_socket=None):
+        try:
+            asyncio.run(self.serve(host, port, unix_socket))
+        except KeyboardInterrupt:
+            print("Server stopped")
+        finally:
+            self.executor.shutdown()
+            if self.result_cache is not None:
+                self.result_cache.save(self.index)
@@ -6,9 +6,17 @@ Ricardo Rodriguez - 98388
 
 import re
 from os.path import exists
+from functools import lru_cache
 import nltk
 from utils import dynamically_init_class
 
+# characters replaced by a space in a term (everything except letters, digits, whitespace and hyphens)
+NON_TOKEN_CHARS = re.compile(r'[^a-zA-Z\d\s-]')
+# every (lowercased) whitespace separated term of a text, in a single pass:
+# clean terms (group 1) only have letters, digits and hyphens and don't start with a hyphen,
+# the other ones (group 2) still have to be filtered with NON_TOKEN_CHARS
+TERMS = re.compile(r'([a-z\d][a-z\d-]*)(?!\S)|(\S+)')
+
 def dynamically_init_tokenizer(**kwargs):
     return dynamically_init_class(__name__, **kwargs)
 
@@ -20,6 +28,9 @@ class Tokenizer:
     def tokenize(self, pub_id, terms):
         raise NotImplementedError
 
+    def stem_cache_stats(self):
+        return None
+
     def get_stemmer(self, stemmer_name):
         # This function is used to get the stemmer object
 
@@ -38,6 +49,7 @@ class PubMedTokenizer(Tokenizer):
                  minL,
                  stopwords_path,
                  stemmer,
+                 stem_cache_size=None,
                  *args,
                  **kwargs):
 
@@ -58,6 +70,13 @@ class PubMedTokenizer(Tokenizer):
         #Stemmer
         self.stemmer_obj = self.get_stemmer(self.stemmer)
 
+        # the vocabulary is much smaller than the number of tokens, so the stems are
+        # memoized in a bounded (LRU) cache shared by every document
+        self.stem_cache_size = stem_cache_size if stem_cache_size else 100000
+        self.stem = None
+        if self.stemmer_obj is not None:
+            self.stem = lru_cache(maxsize=self.stem_cache_size)(self.stemmer_obj.stem)
+
     def get_class(self):
         """
         Return class name
@@ -70,30 +89,55 @@ class PubMedTokenizer(Tokenizer):
         It divides the terms into words, removes stopwords and punctuation
         and applies stemming if it is enabled
 
+        The text is lowercased once and split into terms by a single pass of the
+        precompiled TERMS regex, only the terms with punctuation (or a leading hyphen)
+        need the NON_TOKEN_CHARS substitution
+
         Args:
-            pub_id (str): publication id
-            pub_terms (stri): publication terms
+            terms (str): publication terms
         """
 
+        min_length = self.minL
+        stopwords = self.stopwords
+        stem = self.stem
+
         # Lowercase, remove ponctuation, parentheses, numbers, and replace
         filtered_terms = []
-        for term in terms.split():
+        for clean_term, term in TERMS.findall(terms.lower()):
+
+            if clean_term:
+                if len(clean_term) < min_length or clean_term in stopwords:
+                    continue
+                filtered_terms.append(stem(clean_term) if stem else clean_term)
+                continue
 
-            lower_term = term.lower()
             # remove all non alphanumeric characters for the exception
             # of the hiphens (removed at the beginning)
-            filtered_term = re.sub('[^a-zA-Z\d\s-]',' ',lower_term).lstrip('-')
+            filtered_term = NON_TOKEN_CHARS.sub(' ', term).lstrip('-')
 
-            if not filtered_term or filtered_term.strip() == "" or len(filtered_term) < self.minL or filtered_term in self.stopwords:
+            if not filtered_term or filtered_term.strip() == "" or len(filtered_term) < min_length or filtered_term in stopwords:
                 continue
 
-            if lower_term != filtered_term:
-                for splitted_term in filtered_term.split(' '):
-                    if splitted_term and splitted_term.strip() != "" and len(splitted_term) > self.minL or splitted_term in self.stopwords:
-                        stem_t = self.stemmer_obj.stem(splitted_term) if self.stemmer else splitted_term
-                        filtered_terms.append(stem_t)
-            else:
-                stem_t = self.stemmer_obj.stem(filtered_term) if self.stemmer else filtered_term
-                filtered_terms.append(stem_t)
+            # the parts of the term must be longer than minL (stopwords are kept)
+            for splitted_term in filtered_term.split(' '):
+                if splitted_term and len(splitted_term) > min_length or splitted_term in stopwords:
+                    filtered_terms.append(stem(splitted_term) if stem else splitted_term)
 
         return filtered_terms
+
+    def stem_cache_stats(self):
+        """
+        Hits, misses and size of the stem cache (None if there is no stemmer)
+        """
+        if self.stem is None:
+            return None
+
+        info = self.stem.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'hit_rate': info.hits / lookups if lookups else 0,
+            'size': info.currsize,
+            'max_size': info.maxsize
+        }